@@ -10,6 +10,11 @@ import re
 from app.extensions import *
 
 from app.signals import register_signals
+from app.metrics import register_metrics
+from app.caching import register_cache_invalidation
+from app.request_memo import register_request_memo
+from app.profiler import register_profiler
+from app.search import register_search
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 app_env = os.environ.get("FLASK_ENV")
@@ -25,6 +30,21 @@ def create_app(config_env=app_env):
     # Registering signals
     register_signals(app)
 
+    # Opt-in sampling of request profiles
+    register_profiler(app)
+
+    # Request, SQL, template and cache instrumentation
+    register_metrics(app)
+
+    # Dropping cached data when the rows behind it are committed
+    register_cache_invalidation(app)
+
+    # Sharing unique-key lookups within a request
+    register_request_memo(app)
+
+    # Checking the database supports the search index
+    register_search(app)
+
     # Language url prefix
     lang_list = ",".join(app.config["LANGUAGES"])
     lang_prefix = f"<any({lang_list}):lang>"
@@ -1,4 +1,5 @@
-from flask import Blueprint, flash, render_template, redirect, url_for, current_app
+from datetime import datetime, timedelta
+from flask import Blueprint, abort, flash, render_template, redirect, request, url_for, current_app
 from flask.views import View, MethodView
 from app.models import Album, Tour, User
 from app.album.forms import UpdateAlbumForm
@@ -7,6 +8,13 @@ from app import db
 from flask_login import login_required, current_user
 from functools import wraps
 from flask_babel import _
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms.validators import ValidationError
+from app.bulk import bulk_delete, bulk_update
+from app.pagination import InvalidCursor, keyset_paginate
+from app.records import project
+from app.request_memo import lookup
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, and_
 from app.signals import admin_deleted
 
 
@@ -24,20 +32,104 @@ def admin_required(f):
 admin = Blueprint("admin", __name__, template_folder="templates")
 
 
+# Columns an index starts with, only these can be filtered on
+def indexed_columns(table):
+    leading = {list(index.columns)[0].key for index in table.indexes}
+    leading.update(
+        list(constraint.columns)[0].key
+        for constraint in table.constraints
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint))
+        and constraint.columns
+    )
+    return [column.key for column in table.columns if column.key in leading]
+
+
+# Indexed columns that can also be sorted on; keyset cursors compare with <
+# and >, which neither NULLs nor booleans support
+def sortable_columns(table):
+    return [
+        key
+        for key in indexed_columns(table)
+        if not table.columns[key].nullable
+        and table.columns[key].type.python_type is not bool
+    ]
+
+
+# Method for turning a filter value into a condition that can use the index:
+# text matches by prefix, dates by day, everything else by equality
+def column_filter(column, value):
+    python_type = column.type.python_type
+    if python_type is str:
+        return and_(column >= value, column < value + "\uffff")
+    if python_type is bool:
+        return column == (value.lower() in ("1", "true", "yes"))
+    if python_type is datetime:
+        day = datetime.fromisoformat(value)
+        return and_(column >= day, column < day + timedelta(days=1))
+    return column == python_type(value)
+
+
 class TableView(View):
     decorators = [login_required, admin_required]
 
-    def __init__(self, model, edit_allowed=False):
+    def __init__(self, model, edit_allowed=False, edit_form=None):
         self.model = model
         self.edit_allowed = edit_allowed
+        self.edit_form = edit_form
         self.columns = self.model.__mapper__.columns.keys()
+        self.filterable = indexed_columns(self.model.__table__)
+        self.sortable = sortable_columns(self.model.__table__)
         super(TableView, self).__init__()
 
     def dispatch_request(self):
+        table = self.model.__table__
+        sort = request.args.get("sort", "id")
+        if sort not in self.sortable:
+            abort(400)
+        descending = request.args.get("order", "desc") != "asc"
+
+        query = project(self.model, self.columns)
+        filters = {}
+        for name in self.filterable:
+            value = request.args.get(name, "").strip()
+            if value:
+                try:
+                    query = query.filter(column_filter(table.columns[name], value))
+                except ValueError:
+                    abort(400)
+                filters[name] = value
+
+        # The primary key breaks ties, so every sort order is a stable keyset
+        order_columns = [table.columns[sort]]
+        if sort != "id":
+            order_columns.append(table.columns["id"])
+        try:
+            page = keyset_paginate(
+                query,
+                order_columns,
+                cursor=request.args.get("after"),
+                per_page=current_app.config["ADMIN_ITEMS_PER_PAGE"],
+                descending=descending,
+            )
+        except InvalidCursor:
+            abort(404)
+
+        bulk_form = self.edit_form() if self.edit_form else None
         return render_template(
             "resource_table.html",
-            instances=self.model.query.all(),
+            bulk_form=bulk_form,
+            bulk_parameters=(
+                bulk_update_parameters(self.model, bulk_form) if bulk_form else []
+            ),
+            csrf_token=generate_csrf(),
+            instances=page.items,
+            next_cursor=page.next_cursor,
             columns=self.columns,
+            sortable=self.sortable,
+            filterable=self.filterable,
+            sort=sort,
+            order="desc" if descending else "asc",
+            filters=filters,
             resource_name=self.model.__name__.lower(),
             edit_allowed=self.edit_allowed,
         )
@@ -85,27 +177,101 @@ class ModifyResourceView(MethodView):
 
     def delete(self, resource_id):
         model_instance = self.get_model_instance(resource_id)
-        # admin_deleted.send(
-        #     current_app._get_current_object(),
-        #     a_name = current_user.username,
-        #     r_name = self.resource_name,
-        #     r_id = resource_id
-        # )
+        admin_deleted.send(
+            current_app._get_current_object(),
+            a_name=current_user.username,
+            r_name=self.resource_name,
+            r_id=resource_id,
+        )
         db.session.delete(model_instance)
         db.session.commit()
         return ""
 
     def get_model_instance(self, resource_id):
-        return self.model.query.filter_by(id=resource_id).first()
+        return lookup(self.model, "id", resource_id)
 
     def get_update_parameters(self, form_instance):
-        parameter_list = list(form_instance.__dict__.keys())
-        parameter_list = [
-            parameter
-            for parameter in parameter_list
-            if parameter[0] != "_" and parameter not in ["submit", "csrf_token", "meta"]
-        ]
-        return parameter_list
+        return form_parameters(form_instance)
+
+
+def form_parameters(form_instance):
+    parameter_list = list(form_instance.__dict__.keys())
+    parameter_list = [
+        parameter
+        for parameter in parameter_list
+        if parameter[0] != "_" and parameter not in ["submit", "csrf_token", "meta"]
+    ]
+    return parameter_list
+
+
+# Form fields that can be set on many rows with one UPDATE, see app/bulk.py
+def bulk_update_parameters(model, form_instance):
+    attrs = model.__mapper__.attrs
+    return [
+        parameter
+        for parameter in form_parameters(form_instance)
+        if not attrs[parameter].class_attribute.dispatch.set
+    ]
+
+
+class BulkResourceView(MethodView):
+    decorators = [login_required, admin_required]
+
+    def __init__(self, model, edit_form=None):
+        self.model = model
+        self.edit_form = edit_form
+        self.resource_name = self.model.__name__.lower()
+        super(BulkResourceView, self).__init__()
+
+    def post(self):
+        if current_app.config.get("WTF_CSRF_ENABLED", True):
+            try:
+                validate_csrf(request.form.get("csrf_token"))
+            except ValidationError:
+                abort(400)
+        ids = request.form.getlist("ids", type=int)
+        action = request.form.get("action")
+
+        if action == "delete":
+            deleted = bulk_delete(self.model, ids)
+            # One signal for the whole batch instead of one per row
+            if deleted:
+                admin_deleted.send(
+                    current_app._get_current_object(),
+                    a_name=current_user.username,
+                    r_name=self.resource_name,
+                    r_id=deleted,
+                )
+            message = _("%(count)d items were deleted.", count=len(deleted))
+        elif action == "update" and self.edit_form is not None:
+            form = self.edit_form()
+            submitted = {
+                parameter
+                for parameter in bulk_update_parameters(self.model, form)
+                if getattr(form, parameter).raw_data
+                and getattr(form, parameter).raw_data[0]
+            }
+            # Fields checked against each other can only change together
+            for group in getattr(form, "bulk_together", ()):
+                if submitted & set(group) and not submitted >= set(group):
+                    abort(400)
+            values = {}
+            for parameter in submitted:
+                field = getattr(form, parameter)
+                inline = getattr(type(form), f"validate_{parameter}", None)
+                if not field.validate(form, [inline] if inline else []):
+                    abort(400)
+                values[parameter] = field.data
+            if not values:
+                abort(400)
+            updated = bulk_update(self.model, ids, values)
+            message = _("%(count)d items were updated.", count=len(updated))
+        else:
+            abort(400)
+
+        db.session.commit()
+        flash(message, "success")
+        return redirect(url_for(f"admin.{self.resource_name}_table"))
 
 
 def register_admin_resource(model, edit_form=None):
@@ -122,8 +288,18 @@ def register_admin_resource(model, edit_form=None):
     admin.add_url_rule(
         f"/{resource_name}/",
         view_func=TableView.as_view(
-            f"{resource_name}_table", model=model, edit_allowed=edit_allowed
+            f"{resource_name}_table",
+            model=model,
+            edit_allowed=edit_allowed,
+            edit_form=edit_form,
+        ),
+    )
+    admin.add_url_rule(
+        f"/{resource_name}/bulk",
+        view_func=BulkResourceView.as_view(
+            f"{resource_name}_bulk", model=model, edit_form=edit_form
         ),
+        methods=["POST"],
     )
     admin.add_url_rule(
         f"/{resource_name}/<int:resource_id>", view_func=view_func, methods=view_methods
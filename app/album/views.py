@@ -1,5 +1,5 @@
 # Imports from Flask
-from flask import abort, Blueprint, current_app, flash, redirect, render_template, send_from_directory, url_for
+from flask import abort, Blueprint, current_app, flash, redirect, render_template, request, url_for
 
 # Extension for implementing Flask-Login for authentication
 from flask_login import current_user, login_required
@@ -8,35 +8,77 @@ from flask_login import current_user, login_required
 from flask_babel import _
 from flask_babel import lazy_gettext as _l
 
-# Methods for generating tokens
-from secrets import token_hex
-
 # Methods from Werkzeug for managing password hashing and sanitizing filenames
 from werkzeug.utils import secure_filename
 
 # Other imports
 import os
-import datetime
 from app.album.forms import CreateAlbumForm, UpdateAlbumForm
+from app.files import send_upload
+from app.images import VARIANTS, InvalidImage, derivative_name, generate_derivatives
+from app.images import has_derivatives
 
 # Imports from app package
-from app import db, cache
-from app.models import Album
-from sqlalchemy.orm import joinedload
+from app import db
+from app.caching import fragment_keys, memoize_in, on_cascade_delete, on_change
+from app.models import ALBUM_CARD, Album, User
+from app.pagination import InvalidCursor, Page, keyset_paginate
+from app.records import PageCodec
+from app.slug_cache import resolve_slug
+from app.storage import remove_files, store_stream
+from sqlalchemy import inspect
 
 album = Blueprint("album", __name__, template_folder="templates")
 
-@cache.cached(timeout=60, key_prefix="list_of_albums")
-def get_albums():
+# Every page is memoized under its own cursor, so a miss only loads one page
+@memoize_in("albums", codec=PageCodec(ALBUM_CARD))
+def get_albums(cursor=None):
     # print("Gretting albums from the database")
-    return Album.query.options(joinedload(Album.user)).all()
+    # Only the columns the cards show are loaded, straight into records
+    page = keyset_paginate(
+        ALBUM_CARD.query(),
+        [Album.release_date, Album.id],
+        cursor=cursor,
+        per_page=current_app.config["ITEMS_PER_PAGE"],
+    )
+    return Page([ALBUM_CARD.from_row(row) for row in page.items], page.next_cursor)
+
+# List pages show album data and the owner's username
+@on_change(Album, User)
+def invalidate_album_pages(instance, state, pending):
+    if isinstance(instance, Album) or state == "deleted" or (
+        inspect(instance).attrs.username.history.has_changes()
+    ):
+        pending.namespaces.add("albums")
+
+# Fragments are keyed by row version, so an edited album misses on its own;
+# the stale version is dropped to free the cache
+@on_change(Album)
+def drop_album_fragments(album, state, pending):
+    if state != "new":
+        version = album.version if state == "deleted" else album.version - 1
+        pending.keys.update(
+            fragment_keys(("album_card", "album_detail"), album.id, version)
+        )
+
+# Albums removed together with their user
+@on_cascade_delete(Album)
+def drop_cascaded_album_fragments(model, criterion, pending):
+    pending.namespaces.add("albums")
+    for id, version in db.session.query(Album.id, Album.version).filter(criterion):
+        pending.keys.update(fragment_keys(("album_card", "album_detail"), id, version))
 
 # Route for listing albums
 @album.route("/")
 @login_required
 def list():
-    albums = get_albums()
-    return render_template("list_albums.html", albums=albums)
+    try:
+        page = get_albums(request.args.get("after"))
+    except InvalidCursor:
+        abort(404)
+    return render_template(
+        "list_albums.html", albums=page.items, next_cursor=page.next_cursor
+    )
 
 
 # Route for creating new albums
@@ -50,8 +92,12 @@ def create():
         artist = form.artist.data
         description = form.description.data
         genre = form.genre.data
-        image = save_image_upload(form.image)
         release_date = form.release_date.data
+        try:
+            image = save_image_upload(form.image)
+        except InvalidImage:
+            form.image.errors.append(_("The image could not be read."))
+            return render_template("create_album.html", form=form)
 
         album = Album(
             title, artist, description, genre, image, release_date, current_user.id
@@ -70,11 +116,12 @@ def create():
 def edit(slug):
     form = UpdateAlbumForm()
 
-    album = Album.query.filter_by(slug=slug).first()
+    snapshot = resolve_slug(Album, slug)
 
-    if not album or not current_user.is_album_owner(album):
+    if not snapshot or not current_user.is_album_owner(snapshot):
         flash(_("You are not authorized to do this."), "danger")
         return redirect(url_for("main.home"))
+    album = Album.query.get_or_404(snapshot.id)
 
     if form.validate_on_submit():
         title = form.title.data
@@ -103,10 +150,11 @@ def edit(slug):
 @album.route("/delete/<slug>", methods=["POST"])
 @login_required
 def delete(slug):
-    album = Album.query.filter_by(slug=slug).first()
-    if not album or not current_user.is_album_owner(album):
+    snapshot = resolve_slug(Album, slug)
+    if not snapshot or not current_user.is_album_owner(snapshot):
         flash("You are not authorized to do this.", "danger")
         return redirect(url_for("main.home"))
+    album = Album.query.get_or_404(snapshot.id)
     db.session.delete(album)
     db.session.commit()
     flash(_("The album has been deleted."), "success")
@@ -117,24 +165,41 @@ def delete(slug):
 @album.route("/show/<slug>")
 @login_required
 def show(slug):
-    album = Album.query.filter_by(slug=slug).first()
+    album = resolve_slug(Album, slug)
     if not album:
         abort(404)
     return render_template("show_album.html", album=album)
 
 
-# Route for showing the uploaded images
-@album.route("/uploads/<filename>")
+# Route for showing the uploaded images, ?size= picks a resized variant
+@album.route("/uploads/<path:filename>")
 def uploads(filename):
-    return send_from_directory(current_app.config["IMAGE_UPLOADS"], filename)
-
-
-# Method for saving an uploaded image to the uploads directory
+    directory = current_app.config["IMAGE_UPLOADS"]
+    size = request.args.get("size")
+    if size in VARIANTS:
+        variant = derivative_name(filename, size)
+        if not os.path.isfile(os.path.join(directory, variant)):
+            # The variant may still be backfilled, so don't pin the fallback
+            return send_upload(directory, filename, immutable=False)
+        filename = variant
+    return send_upload(directory, filename)
+
+
+# Method for saving an uploaded image to the content-addressed upload store,
+# raises InvalidImage and drops the new file when it can not be decoded
 def save_image_upload(image):
-    format = "%Y%m%dT%H%M%S"
-    now = datetime.datetime.utcnow().strftime(format)
-    random_string = token_hex(2)
-    filename = random_string + "_" + now + "_" + image.data.filename
-    filename = secure_filename(filename)
-    image.data.save(os.path.join(current_app.config["IMAGE_UPLOADS"], filename))
+    directory = current_app.config["IMAGE_UPLOADS"]
+    extension = os.path.splitext(secure_filename(image.data.filename))[1]
+    filename, created = store_stream(directory, image.data.stream, extension)
+    if created or not has_derivatives(directory, filename):
+        try:
+            generate_derivatives(directory, filename)
+        except InvalidImage as e:
+            current_app.logger.warning("Rejected upload %s: %s", filename, e)
+            if created:
+                remove_files(directory, [filename])
+            raise
+        except OSError as e:
+            # The original is still served when the variants can not be written
+            current_app.logger.warning("No derivatives for %s: %s", filename, e)
     return filename
@@ -15,6 +15,7 @@ from wtforms.validators import (
 from flask_babel import lazy_gettext as _l
 
 from app.models import User
+from app.request_memo import lookup, preload
 
 # Form for user registration
 class RegistrationForm(FlaskForm):
@@ -63,13 +64,18 @@ class RegistrationForm(FlaskForm):
     )
     submit = SubmitField(_l("Register"))
 
+    # Both uniqueness checks are answered by one query
+    def validate(self):
+        preload(User, username=self.username.data, email=self.email.data)
+        return super(RegistrationForm, self).validate()
+
     def validate_username(form, field):
-        user = User.query.filter_by(username=field.data).first()
+        user = lookup(User, "username", field.data)
         if user:
             raise ValidationError("Username already exists.")
 
     def validate_email(form, field):
-        user = User.query.filter_by(email=field.data).first()
+        user = lookup(User, "email", field.data)
         if user:
             raise ValidationError("Email already exists.")
 
@@ -101,6 +107,6 @@ class LoginForm(FlaskForm):
     submit = SubmitField(_l("Login"))
 
     def validate_email(form, field):
-        user = User.query.filter_by(email=field.data).first()
+        user = lookup(User, "email", field.data)
         if user is None:
             raise ValidationError("This email is not registered.")
@@ -8,6 +8,7 @@ from flask_babel import lazy_gettext as _l
 # Imports from the app package
 from app import db
 from app.models import User
+from app.request_memo import lookup
 
 from app.auth.forms import RegistrationForm, LoginForm
 
@@ -44,7 +45,7 @@ def login():
 
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = lookup(User, "email", form.email.data)
         if user is None or not user.check_password(form.password.data):
             flash(_("Invalid username or password"))
             return redirect(url_for("auth.login"))
@@ -0,0 +1,92 @@
+# Set-based bulk operations for the admin. The affected rows are loaded once;
+# deletes run the set-based on_cascade_delete handlers where the model has
+# them, updates run the on_change handlers the way a flush would, to work out
+# cache keys, search rows and file references. The rows are then changed
+# with one UPDATE or DELETE per chunk, and the invalidation is applied once
+# when the caller commits.
+from app.caching import collect_cascades, collect_changes, collect_deletes
+from app.extensions import db
+
+# Stays below SQLite's limit on bound parameters
+CHUNK_SIZE = 500
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def _load(model, column, values):
+    instances = []
+    for chunk in _chunks(values):
+        instances += model.query.filter(column.in_(chunk)).all()
+    return instances
+
+
+def _delete(model, instances):
+    # Children go first, the way the ORM cascades "delete" relationships;
+    # passive_deletes children are left to ON DELETE CASCADE
+    for relationship in model.__mapper__.relationships:
+        if relationship.cascade.delete and not relationship.passive_deletes:
+            for local, remote in relationship.local_remote_pairs:
+                keys = {getattr(instance, local.key) for instance in instances}
+                children = _load(relationship.mapper.class_, remote, keys)
+                if children:
+                    _delete(relationship.mapper.class_, children)
+
+    collect_cascades(db.session, instances)
+    ids = [instance.id for instance in instances]
+    # Models with set-based handlers (the ones ON DELETE CASCADE uses) cost a
+    # few statements per chunk instead of a few per row
+    for chunk in _chunks(ids):
+        if not collect_deletes(db.session, model, model.id.in_(chunk)):
+            collect_changes(db.session, instances, "deleted")
+            break
+    for instance in instances:
+        db.session.expunge(instance)
+    for chunk in _chunks(ids):
+        db.session.query(model).filter(model.id.in_(chunk)).delete(
+            synchronize_session=False
+        )
+
+
+# Method for deleting the rows with the given ids and everything the model
+# cascades to, returns the ids that existed
+def bulk_delete(model, ids):
+    instances = _load(model, model.id, ids)
+    if instances:
+        _delete(model, instances)
+    return [instance.id for instance in instances]
+
+
+# Method for setting the same values on the rows with the given ids, returns
+# the ids that existed. Attributes with "set" listeners (e.g. titles, which
+# rewrite slugs) can not be expressed as one UPDATE and are refused.
+def bulk_update(model, ids, values):
+    attrs = model.__mapper__.attrs
+    for name in values:
+        if attrs[name].class_attribute.dispatch.set:
+            raise ValueError(f"{model.__name__}.{name} can not be bulk updated")
+    version = getattr(model, "version", None)
+
+    # The in-memory changes give the handlers the history a flush would see
+    instances = _load(model, model.id, ids)
+    for instance in instances:
+        for name, value in values.items():
+            setattr(instance, name, value)
+        if version is not None:
+            setattr(instance, version.key, getattr(instance, version.key) + 1)
+    collect_changes(db.session, instances, "dirty")
+    for instance in instances:
+        db.session.expunge(instance)
+
+    columns = dict(values)
+    if version is not None:
+        columns[version.key] = version + 1
+    ids = [instance.id for instance in instances]
+    for chunk in _chunks(ids):
+        db.session.query(model).filter(model.id.in_(chunk)).update(
+            columns, synchronize_session=False
+        )
+    return ids
@@ -0,0 +1,254 @@
+# Two-tier cache backend for Flask-Caching: a size-bounded in-process LRU (L1)
+# in front of a shared backend (L2). Writes are announced on an invalidation
+# bus so every worker drops its L1 copy of the changed keys.
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from weakref import WeakSet
+
+from flask_caching.backends.base import BaseCache
+from werkzeug.utils import import_string
+
+# Values of these types are kept as they are in L1, everything else is pickled
+# so callers never share mutable objects across threads
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+CLEAR_ALL = "*"
+
+
+# In-process stand-in for the Redis channel, used by tests and single-process
+# servers; every cache sharing one bus behaves like a separate worker
+class LocalInvalidationBus:
+    def __init__(self):
+        self._subscribers = WeakSet()
+
+    def subscribe(self, cache):
+        self._subscribers.add(cache)
+
+    def ensure_listener(self):
+        pass
+
+    def publish(self, origin, keys):
+        for cache in list(self._subscribers):
+            if cache.node_id != origin:
+                cache.evict_local(keys)
+
+
+# Redis pub/sub channel; the listener thread starts in each worker process on
+# its first cache access (workers fork after the app is created), and the L1
+# is cleared whenever the connection had to be rebuilt
+class RedisInvalidationBus:
+    def __init__(self, client, channel):
+        self._client = client
+        self._channel = channel
+        self._subscribers = WeakSet()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, cache):
+        self._subscribers.add(cache)
+        self.ensure_listener()
+
+    def ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._listen, name="cache-invalidation", daemon=True
+                ).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                self._deliver(None, [CLEAR_ALL])
+                for message in pubsub.listen():
+                    data = json.loads(message["data"])
+                    self._deliver(data["origin"], data["keys"])
+            except Exception:
+                time.sleep(1)
+
+    def _deliver(self, origin, keys):
+        for cache in list(self._subscribers):
+            if cache.node_id != origin:
+                cache.evict_local(keys)
+
+    def publish(self, origin, keys):
+        self.ensure_listener()
+        self._client.publish(
+            self._channel, json.dumps({"origin": origin, "keys": list(keys)})
+        )
+
+
+class TwoTierCache(BaseCache):
+    def __init__(self, l2, bus, l1_size=2048, l1_timeout=30, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.l2 = l2
+        self.bus = bus
+        self.l1_size = l1_size
+        self.l1_timeout = l1_timeout
+        self.node_id = uuid.uuid4().hex
+        self.stats = {"l1_hit": 0, "l2_hit": 0, "miss": 0}
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+        bus.subscribe(self)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        l2_type = config["CACHE_L2_TYPE"]
+        if "." not in l2_type:
+            l2_type = "flask_caching.backends." + l2_type
+        l2 = import_string(l2_type).factory(app, config, args, dict(kwargs))
+        client = getattr(l2, "_write_client", None)
+        if client is not None:
+            bus = RedisInvalidationBus(client, config["CACHE_INVALIDATION_CHANNEL"])
+        else:
+            bus = LocalInvalidationBus()
+        return cls(
+            l2,
+            bus,
+            l1_size=config["CACHE_L1_SIZE"],
+            l1_timeout=config["CACHE_L1_TIMEOUT"],
+            default_timeout=kwargs.get("default_timeout", 300),
+        )
+
+    # L1 entries live at most l1_timeout seconds, which bounds staleness
+    # when an invalidation message gets lost
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            expires, stored, pickled = entry
+            if expires < time.monotonic():
+                del self._l1[key]
+                return None
+            self._l1.move_to_end(key)
+        return pickle.loads(stored) if pickled else stored
+
+    def _l1_set(self, key, value, timeout):
+        timeout = self._normalize_timeout(timeout)
+        lifetime = self.l1_timeout if timeout == 0 else min(timeout, self.l1_timeout)
+        pickled = not isinstance(value, IMMUTABLE_TYPES)
+        stored = pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if pickled else value
+        with self._lock:
+            self._l1[key] = (time.monotonic() + lifetime, stored, pickled)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+
+    def evict_local(self, keys):
+        with self._lock:
+            if CLEAR_ALL in keys:
+                self._l1.clear()
+            for key in keys:
+                self._l1.pop(key, None)
+
+    def _changed(self, keys):
+        self.evict_local(keys)
+        self.bus.publish(self.node_id, keys)
+
+    def _count(self, outcome, n=1):
+        with self._lock:
+            self.stats[outcome] += n
+
+    # Reads make sure this worker hears about other workers' writes, even
+    # when it never writes itself
+    def get(self, key):
+        self.bus.ensure_listener()
+        value = self._l1_get(key)
+        if value is not None:
+            self._count("l1_hit")
+            return value
+        value = self.l2.get(key)
+        if value is None:
+            self._count("miss")
+            return None
+        self._count("l2_hit")
+        self._l1_set(key, value, None)
+        return value
+
+    def get_many(self, *keys):
+        self.bus.ensure_listener()
+        values = [self._l1_get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        self._count("l1_hit", len(keys) - len(missing))
+        if missing:
+            fetched = dict(zip(missing, self.l2.get_many(*missing)))
+            for i, key in enumerate(keys):
+                if values[i] is None and fetched.get(key) is not None:
+                    values[i] = fetched[key]
+                    self._l1_set(key, values[i], None)
+                    self._count("l2_hit")
+                elif values[i] is None:
+                    self._count("miss")
+        return values
+
+    def set(self, key, value, timeout=None):
+        result = self.l2.set(key, value, timeout)
+        self._changed([key])
+        self._l1_set(key, value, timeout)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = self.l2.set_many(mapping, timeout)
+        self._changed(list(mapping))
+        for key, value in mapping.items():
+            self._l1_set(key, value, timeout)
+        return result
+
+    # Added keys are usually locks, they are never kept in L1
+    def add(self, key, value, timeout=None):
+        added = self.l2.add(key, value, timeout)
+        if added:
+            self._changed([key])
+        return added
+
+    def delete(self, key):
+        result = self.l2.delete(key)
+        self._changed([key])
+        return result
+
+    def delete_many(self, *keys):
+        if not keys:
+            return []
+        unlink = getattr(self.l2, "unlink", None)
+        if unlink is not None:
+            unlink(*keys)
+        else:
+            for key in keys:
+                self.l2.delete(key)
+        self._changed(list(keys))
+        return list(keys)
+
+    def has(self, key):
+        self.bus.ensure_listener()
+        return self._l1_get(key) is not None or self.l2.has(key)
+
+    def inc(self, key, delta=1):
+        result = self.l2.inc(key, delta)
+        self._changed([key])
+        return result
+
+    def dec(self, key, delta=1):
+        result = self.l2.dec(key, delta)
+        self._changed([key])
+        return result
+
+    def clear(self):
+        result = self.l2.clear()
+        self._changed([CLEAR_ALL])
+        return result
+
+    # Method for reporting the share of reads answered by each tier
+    def hit_ratios(self):
+        with self._lock:
+            stats = dict(self.stats)
+        total = sum(stats.values()) or 1
+        return {outcome: count / total for outcome, count in stats.items()}
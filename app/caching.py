@@ -0,0 +1,293 @@
+# Write-triggered cache invalidation built on SQLAlchemy session events.
+# Handlers registered with `on_change` work out which cache entries a flush
+# touches; the entries are dropped only once the transaction commits.
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from hashlib import sha1
+from secrets import token_hex
+from weakref import WeakValueDictionary
+
+from flask import current_app, g, make_response, request, session
+from flask_caching import make_template_fragment_key
+from flask_login import current_user
+from sqlalchemy import event
+
+from app.extensions import db, cache
+
+# Cached entries are dropped on write, the timeout is only a safety net
+SAFETY_TIMEOUT = 60 * 60 * 24
+# How long a recompute may hold the lock before others give up waiting
+LOCK_TIMEOUT = 10
+
+_handlers = defaultdict(list)
+_cascade_handlers = defaultdict(list)
+_local_locks = WeakValueDictionary()
+_local_locks_guard = threading.Lock()
+
+
+# Changes collected during flushes, applied after the commit
+class PendingInvalidation:
+    def __init__(self):
+        self.keys = set()
+        self.values = {}
+        self.namespaces = set()
+        self.memoized = set()
+        self.callbacks = []
+
+    def apply(self):
+        if self.keys:
+            cache.delete_many(*self.keys)
+        # A row written and then deleted in the same transaction must not be
+        # re-cached, so deletes win over values collected earlier
+        values = {k: v for k, v in self.values.items() if k not in self.keys}
+        if values:
+            cache.set_many(values, timeout=SAFETY_TIMEOUT)
+        for namespace in self.namespaces:
+            bump_namespace(namespace)
+        for f in self.memoized:
+            cache.delete_memoized(f)
+        for callback in self.callbacks:
+            callback()
+
+
+# Decorator for registering f(instance, state, pending) for the given models,
+# where state is one of "new", "dirty" or "deleted"
+def on_change(*models):
+    def decorator(f):
+        for model in models:
+            _handlers[model].append(f)
+        return f
+
+    return decorator
+
+
+# Decorator for registering f(model, criterion, pending) for the given models,
+# called before an ON DELETE CASCADE removes the rows matching criterion;
+# handlers work set-based, the rows are never loaded into the session
+def on_cascade_delete(*models):
+    def decorator(f):
+        for model in models:
+            _cascade_handlers[model].append(f)
+        return f
+
+    return decorator
+
+
+def collect_changes(session, instances, state):
+    pending = session.info.setdefault("pending_invalidation", PendingInvalidation())
+    for instance in instances:
+        if state == "dirty" and not session.is_modified(instance):
+            continue
+        for handler in _handlers.get(type(instance), ()):
+            handler(instance, state, pending)
+    return pending
+
+
+# Method for running the cascade handlers of the passive_deletes relationships
+# of instances about to be deleted, one call per relationship for all of them
+def collect_cascades(session, instances):
+    pending = session.info.setdefault("pending_invalidation", PendingInvalidation())
+    by_model = defaultdict(list)
+    for instance in instances:
+        by_model[type(instance)].append(instance)
+    for model, group in by_model.items():
+        for relationship in model.__mapper__.relationships:
+            if not (relationship.passive_deletes and relationship.cascade.delete):
+                continue
+            child = relationship.mapper.class_
+            [(local, remote)] = relationship.local_remote_pairs
+            criterion = remote.in_({getattr(i, local.key) for i in group})
+            for handler in _cascade_handlers.get(child, ()):
+                handler(child, criterion, pending)
+    return pending
+
+
+# Method for running the set-based delete handlers of model for the rows
+# matching criterion, e.g. for bulk deletes; returns False when the model
+# has none and its rows need the per-row handlers
+def collect_deletes(session, model, criterion):
+    handlers = _cascade_handlers.get(model)
+    if not handlers:
+        return False
+    pending = session.info.setdefault("pending_invalidation", PendingInvalidation())
+    for handler in handlers:
+        handler(model, criterion, pending)
+    return True
+
+
+def _before_flush(session, flush_context, instances):
+    if session.deleted:
+        collect_cascades(session, session.deleted)
+
+
+def _after_flush(session, flush_context):
+    collect_changes(session, session.new, "new")
+    collect_changes(session, session.dirty, "dirty")
+    collect_changes(session, session.deleted, "deleted")
+
+
+def _after_commit(session):
+    pending = session.info.pop("pending_invalidation", None)
+    if pending is not None:
+        pending.apply()
+
+
+def _after_rollback(session):
+    session.info.pop("pending_invalidation", None)
+
+
+def register_cache_invalidation(app):
+    for name, listener in (
+        ("before_flush", _before_flush),
+        ("after_flush", _after_flush),
+        ("after_commit", _after_commit),
+        ("after_rollback", _after_rollback),
+    ):
+        if not event.contains(db.session, name, listener):
+            event.listen(db.session, name, listener)
+
+
+# Namespaces group keys that can not be enumerated (e.g. every list page);
+# bumping the version makes all of them unreachable at once
+def namespace_version(namespace):
+    version_key = f"{namespace}:version"
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, token_hex(4), timeout=0)
+        version = cache.get(version_key) or "0"
+    return version
+
+
+def bump_namespace(namespace):
+    cache.set(f"{namespace}:version", token_hex(4), timeout=0)
+
+
+def _local_lock(key):
+    with _local_locks_guard:
+        lock = _local_locks.get(key)
+        if lock is None:
+            lock = _local_locks[key] = threading.Lock()
+        return lock
+
+
+# Method for reading a key, collapsing concurrent misses into one recompute:
+# threads of this worker queue on a local lock, other workers on a cache lock.
+# The timeout may be a callable picking a timeout for the computed value.
+def get_or_set(key, compute, timeout=SAFETY_TIMEOUT):
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    with _local_lock(key):
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        lock_key = f"{key}:lock"
+        if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+            try:
+                value = compute()
+                cache.set(
+                    key, value, timeout=timeout(value) if callable(timeout) else timeout
+                )
+            finally:
+                cache.delete(lock_key)
+            return value
+
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(key)
+            if value is not None:
+                return value
+        return compute()
+
+
+# Decorator for memoizing a function inside a namespace with single-flight
+# misses. A codec (see app/records.py) stores results in its compact form and
+# its schema version becomes part of the key.
+def memoize_in(namespace, timeout=SAFETY_TIMEOUT, codec=None):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args):
+            key = "{}:{}:{}:{}".format(
+                namespace,
+                namespace_version(namespace),
+                f.__name__,
+                ":".join(str(arg) for arg in args),
+            )
+            if codec is None:
+                return get_or_set(key, lambda: f(*args), timeout)
+            payload = get_or_set(
+                f"{key}:{codec.version}", lambda: codec.dumps(f(*args)), timeout
+            )
+            return codec.loads(payload)
+
+        decorated_function.uncached = f
+        return decorated_function
+
+    return decorator
+
+
+def _page_key(namespace, query_args):
+    route = sorted((request.view_args or {}).items())
+    query = [(name, request.args.getlist(name)) for name in sorted(query_args)]
+    return "page:{}:{}:{}:{}:{}:{}".format(
+        namespace, namespace_version(namespace), g.lang, request.endpoint, route, query
+    )
+
+
+# Decorator for caching whole pages that every anonymous visitor sees the
+# same way, per language and route arguments; only the query arguments named
+# in query_args tell pages apart, so arbitrary query strings can not fill the
+# cache. Cached pages carry an ETag and public Cache-Control so a reverse
+# proxy can keep them too, and revalidations are answered with 304.
+# Logged-in visitors and pages with pending flash messages skip the cache and
+# are marked private; the proxy has to bypass its cache for requests carrying
+# the session cookie.
+def cached_page(timeout=180, namespace="pages", query_args=()):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if (
+                request.method not in ("GET", "HEAD")
+                or current_user.is_authenticated
+                or session.get("_flashes")
+            ):
+                response = make_response(f(*args, **kwargs))
+                response.cache_control.private = True
+                response.vary.add("Cookie")
+                return response
+
+            key = _page_key(namespace, query_args)
+            page = cache.get(key)
+            if page is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                page = (sha1(body).hexdigest(), body, response.mimetype)
+                cache.set(key, page, timeout=timeout)
+
+            etag, body, mimetype = page
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = timeout
+            return response.make_conditional(request)
+
+        return decorated_function
+
+    return decorator
+
+
+# Method for listing the fragment keys of one row version in every language,
+# matching `{% cache timeout, name, id, version, g.lang %}` in the templates
+def fragment_keys(names, id, version):
+    return [
+        make_template_fragment_key(name, vary_on=[str(id), str(version), lang])
+        for name in names
+        for lang in current_app.config["LANGUAGES"]
+    ]
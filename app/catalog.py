@@ -0,0 +1,494 @@
+# Bulk loading of users, albums and tours from NDJSON or CSV files. Rows are
+# inserted in batches with one executemany, slow work (cover ingestion,
+# password hashing) fans out to a process pool, and file references, the
+# search index and the list caches are brought up to date per batch instead
+# of per row. Whole catalogs are dumped to and restored from gzip-compressed
+# NDJSON the same way, streaming rows through server-side cursors.
+import base64
+import csv
+import gzip
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, text
+from werkzeug.security import generate_password_hash, safe_join
+from wtforms.validators import Email, Length, ValidationError
+
+from app.caching import bump_namespace
+from app.extensions import db
+from app.images import VARIANTS, InvalidImage, derivative_name
+from app.models import Album, Tour, User, make_slug
+from app.records import RecordType, project
+from app.search import index_documents
+from app.storage import acquire_many, ingest_file
+
+FIELDS = {
+    Album: ["title", "artist", "description", "genre", "image", "release_date"],
+    Tour: ["title", "artist", "description", "genre", "start_date", "end_date"],
+}
+DATE_FIELDS = {"release_date", "start_date", "end_date"}
+NAMESPACES = {Album: "albums", Tour: "tours"}
+
+
+# Tables in dependency order, dumped with all of their columns
+DUMP_FORMAT = 1
+DUMP_TYPES = {model: RecordType(model) for model in (User, Album, Tour)}
+FILES = "files"
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+class InvalidDump(ValueError):
+    pass
+
+
+# Method for streaming records from an NDJSON or CSV file
+def read_records(path, input_format=None):
+    input_format = input_format or ("csv" if path.endswith(".csv") else "ndjson")
+    with open(path, newline="", encoding="utf-8") as f:
+        if input_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Owners:
+    def __init__(self, default):
+        self.default = default
+        self.ids = {}
+
+    # One query per batch for the usernames not seen before
+    def resolve(self, records):
+        names = {record.get("owner") or self.default for record in records}
+        unknown = [name for name in names - set(self.ids) if name]
+        if unknown:
+            self.ids.update(
+                db.session.query(User.username, User.id).filter(
+                    User.username.in_(unknown)
+                )
+            )
+
+
+# Method for the validators of the given kinds a form applies to fields
+def _form_rules(form, fields, kinds=(Length,)):
+    rules = {}
+    for field in fields:
+        unbound = getattr(form, field, None)
+        validators = unbound.kwargs.get("validators", ()) if unbound else ()
+        rules[field] = [v for v in validators if isinstance(v, kinds)]
+    return rules
+
+
+# Method for the Length rules the create forms apply to the fields of model;
+# the forms are imported here because they read the app config
+def _length_rules(model):
+    from app.album.forms import AlbumForm
+    from app.tour.forms import TourForm
+
+    return _form_rules({Album: AlbumForm, Tour: TourForm}[model], FIELDS[model])
+
+
+# Stand-in for a bound field, so form validators can check a bare value
+class _Value:
+    def __init__(self, data):
+        self.data = data
+
+    def gettext(self, string):
+        return string
+
+    def ngettext(self, singular, plural, n):
+        return singular if n == 1 else plural
+
+
+def _check(rules, field, value):
+    if not isinstance(value, str):
+        raise InvalidRecord(f"{field} is not text")
+    for validator in rules.get(field, ()):
+        try:
+            validator(None, _Value(value))
+        except ValidationError as e:
+            raise InvalidRecord(str(e))
+
+
+def _row(model, record, owners, rules):
+    row = {}
+    for field in FIELDS[model]:
+        value = record.get(field)
+        if not value:
+            raise InvalidRecord(f"{field} is missing")
+        if field in DATE_FIELDS:
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                raise InvalidRecord(f"{field} is not an ISO date: {value}")
+        else:
+            _check(rules, field, value)
+        row[field] = value
+    if model is Tour and row["start_date"] > row["end_date"]:
+        raise InvalidRecord("start_date is after end_date")
+    owner = record.get("owner") or owners.default
+    if owner not in owners.ids:
+        raise InvalidRecord(f"unknown owner {owner!r}")
+    row.update(user_id=owners.ids[owner], slug=make_slug(row["title"]), version=1)
+    return row
+
+
+# Method for giving every row a slug no other row of the batch or the table
+# has, checking each round of candidates with one query
+def _unique_slugs(model, rows):
+    taken = set()
+    pending = rows
+    while pending:
+        slugs = {row["slug"] for row in pending}
+        taken.update(
+            slug for (slug,) in db.session.query(model.slug).filter(model.slug.in_(slugs))
+        )
+        retry = []
+        for row in pending:
+            if row["slug"] in taken:
+                row["slug"] = make_slug(row["title"])
+                retry.append(row)
+            else:
+                taken.add(row["slug"])
+        pending = retry
+
+
+def _ingest_images(pool, directory, images_dir, rows):
+    sources = sorted({row["image"] for row in rows})
+    paths = [os.path.join(images_dir, source) for source in sources]
+    stored = {}
+    for source, future in zip(
+        sources, [pool.submit(ingest_file, directory, path) for path in paths]
+    ):
+        try:
+            stored[source] = future.result()
+        except OSError as e:
+            stored[source] = e
+    return stored
+
+
+# Generator importing records of model in batches. After every committed
+# batch it yields the number of records consumed so far, the number of rows
+# inserted and the problems found, as (record number, message); invalid
+# records and covers Pillow can not decode are left out, covers whose
+# variants could not be written are kept. `skip` resumes after a checkpoint.
+def import_records(
+    model, records, owner=None, images_dir=".", batch_size=500, workers=None, skip=0
+):
+    directory = current_app.config["IMAGE_UPLOADS"]
+    owners = _Owners(owner)
+    rules = _length_rules(model)
+    consumed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch in _batches(records, batch_size):
+            numbers = range(consumed + 1, consumed + len(batch) + 1)
+            consumed += len(batch)
+            if consumed <= skip:
+                continue
+            pending = [(n, r) for n, r in zip(numbers, batch) if n > skip]
+
+            owners.resolve([record for _, record in pending])
+            rows, problems = [], []
+            for number, record in pending:
+                try:
+                    rows.append((number, _row(model, record, owners, rules)))
+                except InvalidRecord as e:
+                    problems.append((number, str(e)))
+
+            if model is Album and rows:
+                stored = _ingest_images(
+                    pool, directory, images_dir, [row for _, row in rows]
+                )
+                kept = []
+                for number, row in rows:
+                    result = stored[row["image"]]
+                    if isinstance(result, InvalidImage):
+                        problems.append((number, f"image rejected: {result}"))
+                        continue
+                    if isinstance(result, OSError):
+                        problems.append((number, f"image not stored: {result}"))
+                        continue
+                    row["image"], error = result
+                    if error:
+                        problems.append((number, f"no derivatives: {error}"))
+                    kept.append((number, row))
+                rows = kept
+
+            rows = [row for _, row in rows]
+            if rows:
+                _unique_slugs(model, rows)
+                db.session.execute(model.__table__.insert(), rows)
+                if model is Album:
+                    acquire_many(Counter(row["image"] for row in rows))
+                index_documents(model, model.slug.in_([row["slug"] for row in rows]))
+            db.session.commit()
+            bump_namespace(NAMESPACES[model])
+            yield consumed, len(rows), problems
+
+
+def _is_true(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "y")
+
+
+# Generator importing users in batches, like import_records. Usernames and
+# emails are checked against the table with one query each per batch, every
+# record against the rules of the registration form, and passwords are
+# hashed across the process pool.
+def import_users(records, batch_size=500, workers=None, skip=0):
+    from app.auth.forms import RegistrationForm
+
+    fields = ["username", "email", "password"]
+    rules = _form_rules(RegistrationForm, fields, (Length, Email))
+    consumed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch in _batches(records, batch_size):
+            numbers = range(consumed + 1, consumed + len(batch) + 1)
+            consumed += len(batch)
+            if consumed <= skip:
+                continue
+            pending = [(n, r) for n, r in zip(numbers, batch) if n > skip]
+
+            usernames = {r.get("username") for _, r in pending} - {None, ""}
+            emails = {r.get("email") for _, r in pending} - {None, ""}
+            taken = {
+                value
+                for column, values in ((User.username, usernames), (User.email, emails))
+                if values
+                for (value,) in db.session.query(column).filter(column.in_(values))
+            }
+
+            rows, passwords, problems = [], [], []
+            for number, record in pending:
+                username, email = record.get("username"), record.get("email")
+                password = record.get("password")
+                if not username or not email or not password:
+                    problems.append(
+                        (number, "username, email and password are required")
+                    )
+                elif username in taken or email in taken:
+                    problems.append((number, f"{username} or {email} already exists"))
+                else:
+                    try:
+                        for field in fields:
+                            _check(rules, field, record[field])
+                    except InvalidRecord as e:
+                        problems.append((number, str(e)))
+                        continue
+                    taken.update((username, email))
+                    rows.append(
+                        {
+                            "username": username,
+                            "email": email,
+                            "is_admin": _is_true(record.get("admin", "")),
+                        }
+                    )
+                    passwords.append(password)
+
+            chunksize = max(1, len(passwords) // ((workers or os.cpu_count() or 1) * 4))
+            for row, password_hash in zip(
+                rows, pool.map(generate_password_hash, passwords, chunksize=chunksize)
+            ):
+                row["password_hash"] = password_hash
+            if rows:
+                db.session.execute(User.__table__.insert(), rows)
+            db.session.commit()
+            yield consumed, len(rows), problems
+
+
+# Checkpoints hold the number of records already consumed
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, consumed):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(consumed))
+    os.replace(tmp_path, path)
+
+
+def _write_line(f, value):
+    f.write(json.dumps(value, separators=(",", ":")) + "\n")
+
+
+def _stored_files(directory, image):
+    for name in [image] + [derivative_name(image, variant) for variant in VARIANTS]:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            yield name, path
+
+
+# Generator writing users, albums and tours, and optionally the upload files
+# the albums use, to a gzip-compressed NDJSON file. The first line lists the
+# columns of every table, each following line is [table, values] or
+# ["files", path, base64 data]. Rows stream from server-side cursors, so
+# memory stays flat; the number of lines written per table is yielded after
+# every batch as (table, count).
+def dump_catalog(path, uploads=False, batch_size=1000):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        _write_line(
+            f,
+            {
+                "format": DUMP_FORMAT,
+                "tables": {
+                    model.__tablename__: list(record_type.fields)
+                    for model, record_type in DUMP_TYPES.items()
+                },
+            },
+        )
+        for model, record_type in DUMP_TYPES.items():
+            table = model.__tablename__
+            rows = (
+                project(model, record_type.fields)
+                .order_by(model.id)
+                .yield_per(batch_size)
+            )
+            count = 0
+            for row in rows:
+                _write_line(f, [table, record_type.pack(row)])
+                count += 1
+                if count % batch_size == 0:
+                    yield table, count
+            yield table, count
+
+        if uploads:
+            directory = current_app.config["IMAGE_UPLOADS"]
+            images = db.session.query(Album.image).distinct().yield_per(batch_size)
+            count = 0
+            for (image,) in images:
+                for name, file_path in _stored_files(directory, image):
+                    with open(file_path, "rb") as upload:
+                        data = base64.b64encode(upload.read()).decode("ascii")
+                    _write_line(f, [FILES, name, data])
+                    count += 1
+            yield FILES, count
+
+
+def _restore_file(directory, name, data):
+    path = safe_join(directory, name)
+    if path is None:
+        raise InvalidDump(f"unsafe upload path {name!r}")
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(base64.b64decode(data))
+    os.replace(tmp_path, path)
+
+
+def _decoders(model, columns):
+    record_type = DUMP_TYPES[model]
+    decoders = dict(
+        zip(record_type.fields, (decode for _, decode in record_type.codecs))
+    )
+    unknown = set(columns) - set(decoders)
+    if unknown:
+        raise InvalidDump(f"unknown {model.__tablename__} columns {sorted(unknown)}")
+    return [decoders[column] for column in columns]
+
+
+# Rows keep their dumped ids, so PostgreSQL's id sequences have to move past
+# them or the next insert collides; SQLite picks max(id) + 1 by itself
+def _advance_sequences(models):
+    if db.session.get_bind().dialect.name != "postgresql":
+        return
+    for table in models:
+        db.session.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table}"
+            )
+        )
+
+
+# Generator loading a dump written by dump_catalog into empty tables, in one
+# transaction with one executemany per batch. Upload files are only written
+# when `uploads` is set. File references, the search index and the list
+# caches are rebuilt at the end. Yields progress like dump_catalog.
+def restore_catalog(path, uploads=False, batch_size=1000):
+    models = {model.__tablename__: model for model in DUMP_TYPES}
+    for model in DUMP_TYPES:
+        if db.session.query(model.id).first() is not None:
+            raise InvalidDump(f"{model.__tablename__} is not empty")
+    directory = current_app.config["IMAGE_UPLOADS"]
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != DUMP_FORMAT:
+            raise InvalidDump(f"{path} is not a catalog dump")
+        columns = header.get("tables", {})
+        unknown = set(columns) - set(models)
+        if unknown:
+            raise InvalidDump(f"unknown tables {sorted(unknown)}")
+        decoders = {
+            table: _decoders(models[table], columns[table]) for table in columns
+        }
+
+        table, batch, counts = None, [], Counter()
+
+        def insert():
+            db.session.execute(models[table].__table__.insert(), batch)
+            counts[table] += len(batch)
+            return table, counts[table]
+
+        for line in f:
+            kind, *values = json.loads(line)
+            if kind == FILES:
+                if uploads:
+                    _restore_file(directory, *values)
+                    counts[FILES] += 1
+                continue
+            if kind not in decoders:
+                raise InvalidDump(f"unknown table {kind!r}")
+            if kind != table or len(batch) == batch_size:
+                if batch:
+                    yield insert()
+                table, batch = kind, []
+            (values,) = values
+            batch.append(
+                {
+                    column: None if value is None else decode(value)
+                    for column, decode, value in zip(
+                        columns[table], decoders[table], values
+                    )
+                }
+            )
+        if batch:
+            yield insert()
+        if uploads:
+            yield FILES, counts[FILES]
+
+    images = db.session.query(Album.image, func.count()).group_by(Album.image)
+    references = dict(images)
+    if references:
+        acquire_many(references)
+    for model in (Album, Tour):
+        index_documents(model)
+    _advance_sequences(models)
+    db.session.commit()
+    for namespace in NAMESPACES.values():
+        bump_namespace(namespace)
@@ -0,0 +1,81 @@
+# Non-blocking structured event log: request threads summarize an event into
+# a small dict and hand it to a bounded queue, a background thread writes
+# the records as JSON lines. Records are dropped instead of blocking when
+# the writer falls behind.
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+MAX_STRING = 80
+
+
+# Method for describing a template context value without calling repr on it,
+# so lazy relationships are never loaded just for logging
+def summarize(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return value if len(value) <= MAX_STRING else value[:MAX_STRING] + "..."
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        return {"type": type(value).__name__, "len": len(value)}
+    state = getattr(value, "__dict__", None)
+    if state is not None and "id" in state:
+        return f"<{type(value).__name__} id={state['id']}>"
+    return f"<{type(value).__name__}>"
+
+
+class EventLog:
+    def __init__(self, stream=None, maxsize=10000):
+        self.stream = stream
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Workers fork after import, so the writer starts on first use per process
+    def _ensure_writer(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._write, name="event-log-writer", daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            try:
+                stream = self.stream or sys.stdout
+                stream.write(json.dumps(record, default=str) + "\n")
+                if self.queue.empty():
+                    stream.flush()
+            except Exception:
+                pass
+            finally:
+                self.queue.task_done()
+
+    def emit(self, event, **fields):
+        self._ensure_writer()
+        fields["event"] = event
+        fields["ts"] = round(time.time(), 6)
+        try:
+            self.queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    # Method for waiting until the queued records have been written
+    def drain(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+
+event_log = EventLog()
+atexit.register(event_log.drain)
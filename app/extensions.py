@@ -15,6 +15,10 @@ from flask import g
 # Extension for implementing cache
 from flask_caching import Cache
 
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 db = SQLAlchemy()
 babel = Babel()
 login_manager = LoginManager()
@@ -30,6 +34,16 @@ def init_extensions(app):
     login_manager.session_protection = "strong"
     login_manager.login_message = _l("You need to be logged in to access this page.")
     login_manager.login_message_category = "danger"
+    if not event.contains(Engine, "connect", enable_sqlite_foreign_keys):
+        event.listen(Engine, "connect", enable_sqlite_foreign_keys)
+
+
+# SQLite only enforces foreign keys, and ON DELETE CASCADE, when asked to
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 
 @babel.localeselector
@@ -0,0 +1,66 @@
+# Serving of uploaded files: strong content-based ETags, 304 and Range
+# handling, far-future caching and optional offload to the reverse proxy
+import mimetypes
+import os
+from functools import lru_cache
+from hashlib import sha256
+
+from flask import current_app, request, safe_join, send_from_directory
+from werkzeug.exceptions import NotFound
+
+ONE_YEAR = 60 * 60 * 24 * 365
+CHUNK_SIZE = 64 * 1024
+
+
+# Hashes are cached per file version, so each file is read at most once
+@lru_cache(maxsize=4096)
+def _content_hash(path, mtime_ns, size):
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_etag(path):
+    stat = os.stat(path)
+    return _content_hash(path, stat.st_mtime_ns, stat.st_size)
+
+
+# Method for sending an upload; immutable responses may be cached forever,
+# since upload names never get reused for different content
+def send_upload(directory, filename, immutable=True):
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mode = current_app.config.get("UPLOADS_SENDFILE")
+    if mode:
+        # The proxy streams the bytes, the worker only sends the headers
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        if mode == "x-accel-redirect":
+            prefix = current_app.config["UPLOADS_ACCEL_PREFIX"].rstrip("/")
+            response.headers["X-Accel-Redirect"] = f"{prefix}/{filename}"
+        else:
+            response.headers["X-Sendfile"] = path
+    else:
+        response = send_from_directory(
+            directory,
+            filename,
+            conditional=False,
+            add_etags=False,
+            cache_timeout=0,
+        )
+
+    response.set_etag(content_etag(path))
+    if immutable:
+        response.headers["Cache-Control"] = f"public, max-age={ONE_YEAR}, immutable"
+    else:
+        response.headers["Cache-Control"] = "public, max-age=300"
+    if mode:
+        return response.make_conditional(request)
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=os.path.getsize(path)
+    )
@@ -0,0 +1,63 @@
+# Derivative pipeline for uploaded album covers: every upload is re-encoded
+# into a few fixed sizes so pages never ship the original file
+import os
+
+from PIL import Image, ImageOps
+
+# Longest edge in pixels, keyed by the `size` argument of album.uploads
+VARIANTS = {"thumb": 160, "card": 480, "full": 1200}
+JPEG_QUALITY = 82
+
+
+# Raised for files Pillow can not decode, or refuses to because they would
+# decompress to more than Image.MAX_IMAGE_PIXELS
+class InvalidImage(OSError):
+    pass
+
+
+def derivative_name(filename, variant):
+    stem, _ = os.path.splitext(filename)
+    return f"{stem}.{variant}.jpg"
+
+
+def is_derivative(filename):
+    return any(filename.endswith(f".{variant}.jpg") for variant in VARIANTS)
+
+
+def _flatten(image):
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+# Method for writing every derivative of an upload next to it, from the
+# largest to the smallest so each resize starts from a smaller image
+def generate_derivatives(directory, filename):
+    try:
+        with Image.open(os.path.join(directory, filename)) as original:
+            image = _flatten(original)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f"{filename} is not a usable image: {e}") from e
+    for variant, size in sorted(VARIANTS.items(), key=lambda v: -v[1]):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        path = os.path.join(directory, derivative_name(filename, variant))
+        image.save(
+            path + ".tmp",
+            "JPEG",
+            quality=JPEG_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+        os.replace(path + ".tmp", path)
+    return filename
+
+
+def has_derivatives(directory, filename):
+    return all(
+        os.path.isfile(os.path.join(directory, derivative_name(filename, variant)))
+        for variant in VARIANTS
+    )
@@ -1,7 +1,8 @@
 # Imports from Flask
-from flask import Blueprint, current_app, redirect, render_template, url_for
-from flask_login import current_user
-from app import cache
+from flask import Blueprint, current_app, redirect, render_template, request, url_for
+from flask_login import current_user, login_required
+from app.caching import cached_page
+from app.search import search as search_catalog
 
 main = Blueprint("main", __name__, template_folder="templates")
 
@@ -10,7 +11,29 @@ def root():
 
 # Home route
 @main.route("/")
-@cache.cached(timeout=180, unless=lambda: current_user.is_authenticated)
+@cached_page(timeout=180)
 def home():
     # print("Home page is rendered")
     return render_template("home.html")
+
+
+# Route for searching albums and tours
+@main.route("/search")
+@login_required
+def search():
+    query = request.args.get("q", "").strip()
+    last_page = current_app.config["SEARCH_MAX_PAGE"]
+    page = min(max(request.args.get("page", 1, type=int), 1), last_page)
+    results, has_next = [], False
+    if query:
+        results, has_next = search_catalog(
+            query, page=page, per_page=current_app.config["ITEMS_PER_PAGE"]
+        )
+        has_next = has_next and page < last_page
+    return render_template(
+        "search.html",
+        query=query,
+        page=page,
+        has_next=has_next,
+        results=[(type(result).__name__.lower(), result) for result in results],
+    )
@@ -0,0 +1,279 @@
+# Low-overhead request instrumentation: latency histograms per endpoint,
+# SQL statement counts and time, template render time and cache hit ratio
+# (per tier when the two-tier backend is in use).
+# Each worker aggregates in memory and periodically publishes a snapshot to
+# the cache, where the /metrics endpoint and `flask metrics` merge them.
+# Snapshots expire when a worker stops publishing, and the list of workers is
+# pruned of them whenever the snapshots are merged.
+import hmac
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import abort, before_render_template, current_app, g
+from flask import has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.extensions import cache
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 10
+# Workers idle for longer drop out of the merged metrics
+WORKER_TIMEOUT = 10 * 60
+WORKERS_KEY = "metrics:workers"
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+
+    def __getstate__(self):
+        return (self.counts, self.total, self.count)
+
+    def __setstate__(self, state):
+        self.counts, self.total, self.count = state
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(Histogram)
+        self.templates = defaultdict(Histogram)
+        self.sql_statements = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.cache = defaultdict(int)
+        self.cache_tiers = defaultdict(int)
+
+    def observe_request(self, endpoint, seconds, statements, sql_seconds):
+        with self.lock:
+            self.requests[endpoint].observe(seconds)
+            self.sql_statements[endpoint] += statements
+            self.sql_seconds[endpoint] += sql_seconds
+
+    def observe_template(self, name, seconds):
+        with self.lock:
+            self.templates[name].observe(seconds)
+
+    def count_cache(self, outcome, n=1):
+        with self.lock:
+            self.cache[outcome] += n
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "templates": dict(self.templates),
+                "sql_statements": dict(self.sql_statements),
+                "sql_seconds": dict(self.sql_seconds),
+                "cache": dict(self.cache),
+                "cache_tiers": dict(self.cache_tiers),
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name in ("requests", "templates"):
+                for key, histogram in snapshot[name].items():
+                    getattr(self, name)[key].merge(histogram)
+            for name in ("sql_statements", "sql_seconds", "cache", "cache_tiers"):
+                for key, value in snapshot.get(name, {}).items():
+                    getattr(self, name)[key] += value
+
+
+metrics = Metrics()
+
+
+def _histogram_lines(name, label, histograms):
+    lines = [f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.total:.6f}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+    return lines
+
+
+def _counter_lines(name, label, values):
+    lines = [f"# TYPE {name} counter"]
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{key}"}} {value:g}')
+    return lines
+
+
+# Method for rendering a snapshot in the Prometheus text format
+def render_text(snapshot):
+    lines = []
+    lines += _histogram_lines(
+        "http_request_duration_seconds", "endpoint", snapshot["requests"]
+    )
+    lines += _counter_lines(
+        "sql_statements_total", "endpoint", snapshot["sql_statements"]
+    )
+    lines += _counter_lines("sql_seconds_total", "endpoint", snapshot["sql_seconds"])
+    lines += _histogram_lines(
+        "template_render_seconds", "template", snapshot["templates"]
+    )
+    lines += _counter_lines("cache_requests_total", "outcome", snapshot["cache"])
+    lines += _counter_lines(
+        "cache_tier_requests_total", "outcome", snapshot["cache_tiers"]
+    )
+    return "\n".join(lines) + "\n"
+
+
+# Proxy in front of the cache backend counting hits and misses
+class InstrumentedCache:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def get(self, key):
+        value = self._backend.get(key)
+        metrics.count_cache("miss" if value is None else "hit")
+        return value
+
+    def get_many(self, *keys):
+        values = self._backend.get_many(*keys)
+        misses = sum(value is None for value in values)
+        metrics.count_cache("miss", misses)
+        metrics.count_cache("hit", len(values) - misses)
+        return values
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+
+def _worker_key():
+    return f"metrics:{socket.gethostname()}:{os.getpid()}"
+
+
+_last_flush = [0.0]
+
+
+# Method for publishing this worker's snapshot for the other processes
+def flush(force=False):
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < FLUSH_INTERVAL:
+        return
+    _last_flush[0] = now
+    key = _worker_key()
+    snapshot = metrics.snapshot()
+    # Two-tier backends count which tier answered each read
+    snapshot["cache_tiers"] = dict(getattr(cache.cache, "stats", {}))
+    cache.set(key, snapshot, timeout=WORKER_TIMEOUT)
+    # The list is read and written without a lock; a worker whose entry was
+    # lost to a concurrent update adds itself again on its next flush
+    workers = cache.get(WORKERS_KEY) or []
+    if key not in workers:
+        cache.set(WORKERS_KEY, workers + [key], timeout=0)
+
+
+# Method for merging the snapshots every worker published, dropping the
+# workers whose snapshot expired from the list
+def collect():
+    merged = Metrics()
+    workers = cache.get(WORKERS_KEY) or []
+    live = []
+    for key in workers:
+        snapshot = cache.get(key)
+        if snapshot:
+            merged.merge(snapshot)
+            live.append(key)
+    if len(live) < len(workers):
+        cache.set(WORKERS_KEY, live, timeout=0)
+    return merged.snapshot()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and conn.info.get("query_start"):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        g.sql_statements = g.get("sql_statements", 0) + 1
+        g.sql_seconds = g.get("sql_seconds", 0.0) + elapsed
+
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault("render_starts", []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get("render_starts")
+    if starts:
+        metrics.observe_template(
+            template.name or "template string", time.perf_counter() - starts.pop()
+        )
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+
+
+def _finish_request(exc):
+    start = g.get("request_start")
+    if start is None:
+        return
+    metrics.observe_request(
+        request.endpoint or "unmatched",
+        time.perf_counter() - start,
+        g.get("sql_statements", 0),
+        g.get("sql_seconds", 0.0),
+    )
+    flush()
+
+
+def _authorized():
+    if request.remote_addr in current_app.config["METRICS_ALLOWED_IPS"]:
+        return True
+    token = current_app.config["METRICS_TOKEN"]
+    header = request.headers.get("Authorization", "")
+    return bool(token) and hmac.compare_digest(header, f"Bearer {token}")
+
+
+def metrics_endpoint():
+    if not _authorized():
+        abort(403)
+    flush(force=True)
+    return render_text(collect()), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def register_metrics(app):
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+    for name, listener in (
+        ("before_cursor_execute", _before_cursor_execute),
+        ("after_cursor_execute", _after_cursor_execute),
+    ):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.before_request(_start_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
+
+    extension = app.extensions["cache"]
+    for key, backend in extension.items():
+        if not isinstance(backend, InstrumentedCache):
+            extension[key] = InstrumentedCache(backend)
@@ -0,0 +1,26 @@
+"""add list pagination indexes
+
+Revision ID: 3c1f8e2b9d47
+Revises: a5dd6ff0aae4
+Create Date: 2026-10-17 09:12:41.503112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f8e2b9d47'
+down_revision = 'a5dd6ff0aae4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_albums_release_date_id', 'albums', ['release_date', 'id'], unique=False)
+    op.create_index('ix_tours_start_date_id', 'tours', ['start_date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tours_start_date_id', table_name='tours')
+    op.drop_index('ix_albums_release_date_id', table_name='albums')
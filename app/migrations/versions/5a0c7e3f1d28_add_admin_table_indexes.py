@@ -0,0 +1,44 @@
+"""add admin table indexes
+
+Revision ID: 5a0c7e3f1d28
+Revises: d2f6a8c41b93
+Create Date: 2026-10-17 15:02:19.284607
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a0c7e3f1d28'
+down_revision = 'd2f6a8c41b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # users.is_admin was added to the model without a migration of its own
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('users')]
+    if 'is_admin' not in columns:
+        with op.batch_alter_table('users', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('is_admin', sa.Boolean(), nullable=True))
+
+    op.create_index('ix_albums_title_id', 'albums', ['title', 'id'], unique=False)
+    op.create_index('ix_albums_artist_id', 'albums', ['artist', 'id'], unique=False)
+    op.create_index('ix_albums_genre_id', 'albums', ['genre', 'id'], unique=False)
+    op.create_index('ix_tours_end_date_id', 'tours', ['end_date', 'id'], unique=False)
+    op.create_index('ix_tours_title_id', 'tours', ['title', 'id'], unique=False)
+    op.create_index('ix_tours_artist_id', 'tours', ['artist', 'id'], unique=False)
+    op.create_index('ix_tours_genre_id', 'tours', ['genre', 'id'], unique=False)
+    op.create_index('ix_users_is_admin_id', 'users', ['is_admin', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_users_is_admin_id', table_name='users')
+    op.drop_index('ix_tours_genre_id', table_name='tours')
+    op.drop_index('ix_tours_artist_id', table_name='tours')
+    op.drop_index('ix_tours_title_id', table_name='tours')
+    op.drop_index('ix_tours_end_date_id', table_name='tours')
+    op.drop_index('ix_albums_genre_id', table_name='albums')
+    op.drop_index('ix_albums_artist_id', table_name='albums')
+    op.drop_index('ix_albums_title_id', table_name='albums')
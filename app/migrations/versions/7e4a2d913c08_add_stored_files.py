@@ -0,0 +1,28 @@
+"""add stored files
+
+Revision ID: 7e4a2d913c08
+Revises: 3c1f8e2b9d47
+Create Date: 2026-10-17 11:40:03.218754
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e4a2d913c08'
+down_revision = '3c1f8e2b9d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stored_files',
+    sa.Column('path', sa.String(length=255), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('path')
+    )
+
+
+def downgrade():
+    op.drop_table('stored_files')
@@ -0,0 +1,45 @@
+"""cascade user deletes
+
+Revision ID: 8f3b61d0c7a4
+Revises: 5a0c7e3f1d28
+Create Date: 2026-10-17 16:40:03.118529
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3b61d0c7a4'
+down_revision = '5a0c7e3f1d28'
+branch_labels = None
+depends_on = None
+
+# The initial migration left the foreign keys unnamed, on SQLite the batch
+# copy finds them through this naming convention
+naming_convention = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+}
+
+
+def _replace_user_fk(table, ondelete):
+    name = f'fk_{table}_user_id_users'
+    if op.get_bind().dialect.name == 'sqlite':
+        existing = name
+    else:
+        existing = f'{table}_user_id_fkey'
+    with op.batch_alter_table(table, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint(existing, type_='foreignkey')
+        batch_op.create_foreign_key(
+            name, 'users', ['user_id'], ['id'], ondelete=ondelete
+        )
+
+
+def upgrade():
+    _replace_user_fk('albums', 'CASCADE')
+    _replace_user_fk('tours', 'CASCADE')
+
+
+def downgrade():
+    _replace_user_fk('tours', None)
+    _replace_user_fk('albums', None)
@@ -0,0 +1,52 @@
+"""add search index
+
+Revision ID: b91d4c7f2e65
+Revises: 7e4a2d913c08
+Create Date: 2026-10-17 13:05:27.940316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b91d4c7f2e65'
+down_revision = '7e4a2d913c08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE search_index USING fts5("
+            "title, artist, description, genre, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        key = 'rowid'
+    else:
+        op.execute(
+            "CREATE TABLE search_index ("
+            "doc_id BIGINT PRIMARY KEY, "
+            "title TEXT, artist TEXT, description TEXT, genre TEXT, "
+            "document TSVECTOR GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(artist, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(genre, '')), 'B') || "
+            "setweight(to_tsvector('simple', coalesce(description, '')), 'C')"
+            ") STORED)"
+        )
+        op.execute(
+            "CREATE INDEX ix_search_index_document "
+            "ON search_index USING GIN (document)"
+        )
+        key = 'doc_id'
+    for table, kind in (('albums', 0), ('tours', 1)):
+        op.execute(
+            f"INSERT INTO search_index ({key}, title, artist, description, genre) "
+            f"SELECT id * 2 + {kind}, title, artist, description, genre FROM {table}"
+        )
+
+
+def downgrade():
+    op.execute("DROP TABLE search_index")
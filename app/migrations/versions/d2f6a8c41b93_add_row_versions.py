@@ -0,0 +1,32 @@
+"""add row versions
+
+Revision ID: d2f6a8c41b93
+Revises: b91d4c7f2e65
+Create Date: 2026-10-17 14:22:51.610487
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f6a8c41b93'
+down_revision = 'b91d4c7f2e65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('albums', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+    with op.batch_alter_table('tours', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('tours', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('albums', schema=None) as batch_op:
+        batch_op.drop_column('version')
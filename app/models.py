@@ -1,8 +1,12 @@
 # Extension for implementing SQAlchemy ORM
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+
+# Imports from Flask
+from flask import current_app, has_request_context, request, session
 
 # Extension for implementing Flask-Login for authentication
 from flask_login import UserMixin
+from flask_login.config import COOKIE_NAME
 
 # Methods from Werkzeug for managing password hashing and sanitizing filenames
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -12,13 +16,23 @@ from slugify import slugify
 
 # Methods for generating tokens
 from secrets import token_urlsafe
+from hashlib import sha256
 
 # Imports from the app package
 from app import db, login_manager, cache
+from app.caching import SAFETY_TIMEOUT, get_or_set, on_cascade_delete, on_change
+from app.records import RecordType
+from app.request_memo import memoized
 
 # Album SQLAlchemy model
 class Album(db.Model):
     __tablename__ = "albums"
+    __table_args__ = (
+        db.Index("ix_albums_release_date_id", "release_date", "id"),
+        db.Index("ix_albums_title_id", "title", "id"),
+        db.Index("ix_albums_artist_id", "artist", "id"),
+        db.Index("ix_albums_genre_id", "genre", "id"),
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     title = db.Column(db.String(255), nullable=False)
@@ -27,8 +41,17 @@ class Album(db.Model):
     genre = db.Column(db.String(255), nullable=False)
     image = db.Column(db.Text(), nullable=False)
     release_date = db.Column(db.DateTime(), nullable=False)
-    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), index=True, nullable=False)
-    slug = db.Column(db.String(255), nullable=False, unique=True)
+    user_id = db.Column(
+        db.Integer(),
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    # Old slugs must stay in the history so their cache entries can be dropped
+    slug = db.column_property(
+        db.Column(db.String(255), nullable=False, unique=True), active_history=True
+    )
+    version = db.Column(db.Integer(), nullable=False, default=1)
 
     def __init__(self, title, artist, description, genre, image, release_date, user_id):
         self.title = title
@@ -39,10 +62,20 @@ class Album(db.Model):
         self.release_date = release_date
         self.user_id = user_id
 
+    def __repr__(self):
+        return "<Album %r>" % self.slug
+
 
 # Tour SQLAlchemy model
 class Tour(db.Model):
     __tablename__ = "tours"
+    __table_args__ = (
+        db.Index("ix_tours_start_date_id", "start_date", "id"),
+        db.Index("ix_tours_end_date_id", "end_date", "id"),
+        db.Index("ix_tours_title_id", "title", "id"),
+        db.Index("ix_tours_artist_id", "artist", "id"),
+        db.Index("ix_tours_genre_id", "genre", "id"),
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     title = db.Column(db.String(255), nullable=False)
@@ -51,8 +84,17 @@ class Tour(db.Model):
     genre = db.Column(db.String(255), nullable=False)
     start_date = db.Column(db.DateTime(), nullable=False)
     end_date = db.Column(db.DateTime(), nullable=False)
-    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), index=True, nullable=False)
-    slug = db.Column(db.String(255), nullable=False, unique=True)
+    user_id = db.Column(
+        db.Integer(),
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    # Old slugs must stay in the history so their cache entries can be dropped
+    slug = db.column_property(
+        db.Column(db.String(255), nullable=False, unique=True), active_history=True
+    )
+    version = db.Column(db.Integer(), nullable=False, default=1)
 
     def __init__(self, title, artist, description, genre, start_date, end_date, user_id):
         self.title = title
@@ -63,26 +105,69 @@ class Tour(db.Model):
         self.end_date = end_date
         self.user_id = user_id
 
+    def __repr__(self):
+        return "<Tour %r>" % self.slug
+
+
+# Reference count of a content-addressed upload
+class StoredFile(db.Model):
+    __tablename__ = "stored_files"
+
+    path = db.Column(db.String(255), primary_key=True)
+    refcount = db.Column(db.Integer(), nullable=False, default=0)
+
+
+# Method for making a slug from a title, the random suffix keeps it unique
+# without looking at the existing slugs
+def make_slug(title):
+    return slugify(title) + "-" + token_urlsafe(3)
+
 
 # Method for updating slugs on title update
 def update_slug(target, value, old_value, initiator):
-    target.slug = slugify(value) + "-" + token_urlsafe(3)
+    target.slug = make_slug(value)
 
 
 event.listen(Album.title, "set", update_slug)
 event.listen(Tour.title, "set", update_slug)
 
 
+# Method for bumping the version that keys the cached fragments of a row.
+# The UPDATE increments the stored value, so concurrent edits get distinct
+# versions while the last one still wins, with no stale-row checks.
+def bump_version(mapper, connection, target):
+    if inspect(target).session.is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
+
+
+event.listen(Album, "before_update", bump_version)
+event.listen(Tour, "before_update", bump_version)
+
+
 # User SQLAlchemy model
 class User(UserMixin, db.Model):
     __tablename__ = "users"
+    __table_args__ = (db.Index("ix_users_is_admin_id", "is_admin", "id"),)
 
     id = db.Column(db.Integer(), primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(64), unique=True, index=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
-    albums = db.relationship("Album", backref="user", lazy="dynamic", cascade="all, delete-orphan")
-    tours = db.relationship("Tour", backref="user", lazy="dynamic", cascade="all, delete-orphan")
+    # Children are removed by ON DELETE CASCADE, see caching.on_cascade_delete
+    albums = db.relationship(
+        "Album",
+        backref="user",
+        lazy="dynamic",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+    tours = db.relationship(
+        "Tour",
+        backref="user",
+        lazy="dynamic",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
     is_admin = db.Column(db.Boolean(), default=False)
 
     def __init__(self, username="", email="", password=""):
@@ -100,7 +185,12 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    @cache.memoize(timeout=180)
+    # Sessions and remember cookies store this id, so a password change
+    # logs every other session out (see load_user)
+    def get_id(self):
+        return f"{self.id}:{password_fingerprint(self)}"
+
+    @cache.memoize(timeout=SAFETY_TIMEOUT)
     def is_album_owner(self, album):
         # print("Checked {} against {}".format(
         #     self.username,
@@ -115,6 +205,96 @@ class User(UserMixin, db.Model):
         self.is_admin = True
 
 
+# Owner checks only go stale when an album is removed or changes hands
+@on_change(Album)
+def invalidate_owner_checks(album, state, pending):
+    if state == "deleted" or inspect(album).attrs.user_id.history.has_changes():
+        pending.memoized.add(User.is_album_owner)
+
+
+@on_cascade_delete(Album)
+def invalidate_cascaded_owner_checks(model, criterion, pending):
+    pending.memoized.add(User.is_album_owner)
+
+
+# Lightweight stand-in for the logged-in user, rebuilt from the cache
+class CachedUser(UserMixin):
+    __repr__ = User.__repr__
+    is_tour_owner = User.is_tour_owner
+
+    def get_id(self):
+        return f"{self.id}:{self.password_fingerprint}"
+
+    # Pages asking twice about one album read the memoized answer once
+    def is_album_owner(self, album):
+        return memoized(
+            Album,
+            ("is_album_owner", self.id, album.id),
+            lambda: User.is_album_owner(self, album),
+        )
+
+
+def password_fingerprint(user):
+    return sha256(user.password_hash.encode()).hexdigest()[:16]
+
+
+# Compact cache snapshots of the models, see app/records.py
+ALBUM_SNAPSHOT = RecordType(Album)
+TOUR_SNAPSHOT = RecordType(Tour)
+OWNER_NAME = RecordType(User, ("id", "username"))
+ALBUM_CARD = RecordType(Album, related={"user": OWNER_NAME})
+TOUR_CARD = RecordType(Tour, related={"user": OWNER_NAME})
+USER_IDENTITY = RecordType(
+    User,
+    ("id", "username", "is_admin"),
+    computed={"password_fingerprint": password_fingerprint},
+    base=CachedUser,
+)
+
+
+def user_identity_key(user_id):
+    return f"user:{USER_IDENTITY.version}:{user_id}"
+
+
+# Cached identities change with set_password, make_admin and user deletion
+@on_change(User)
+def refresh_user_identity(user, state, pending):
+    key = user_identity_key(user.id)
+    if state == "deleted":
+        pending.keys.add(key)
+    elif state == "dirty":
+        pending.values[key] = USER_IDENTITY.dumps(user)
+
+
+# Sessions and remember cookies issued before ids carried the password
+# fingerprint hold a bare id; they are rewritten to the current format
+# instead of being logged out
+def _upgrade_session(identity):
+    if not has_request_context():
+        return
+    session["_user_id"] = identity.get_id()
+    cookie_name = current_app.config.get("REMEMBER_COOKIE_NAME", COOKIE_NAME)
+    if cookie_name in request.cookies and session.get("_remember") != "clear":
+        session["_remember"] = "set"
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    legacy = ":" not in user_id
+    user_id, _, fingerprint = user_id.partition(":")
+    if not user_id.isdigit():
+        return None
+
+    def load():
+        user = User.query.get(int(user_id))
+        return USER_IDENTITY.dumps(user) if user else None
+
+    payload = get_or_set(user_identity_key(int(user_id)), load)
+    identity = USER_IDENTITY.loads(payload) if payload else None
+    if identity is None:
+        return None
+    if legacy:
+        _upgrade_session(identity)
+    elif identity.password_fingerprint != fingerprint:
+        return None
+    return identity
@@ -0,0 +1,67 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+import json
+
+from sqlalchemy import and_, or_
+
+# One page of a keyset-paginated query
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# Method for turning the ordering values of the last row into an opaque cursor
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+# Method for reading a cursor back into values comparable with the order columns
+def decode_cursor(cursor, order_columns):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(cursor + padding))
+        if len(values) != len(order_columns):
+            raise InvalidCursor(cursor)
+        # Sort columns are never NULL, see admin.views.sortable_columns
+        if None in values:
+            raise InvalidCursor(cursor)
+        return [
+            datetime.fromisoformat(v)
+            if column.type.python_type is datetime
+            else column.type.python_type(v)
+            for column, v in zip(order_columns, values)
+        ]
+    except (TypeError, ValueError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+# Method for building "row comes after the cursor" for a compound ordering,
+# e.g. (a < x) OR (a = x AND b < y) when descending
+def _after(order_columns, values, descending):
+    clauses = []
+    for i, (column, value) in enumerate(zip(order_columns, values)):
+        equal = [c == v for c, v in zip(order_columns[:i], values[:i])]
+        beyond = column < value if descending else column > value
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+
+# Method for fetching one page of a query ordered by a stable, unique key
+def keyset_paginate(query, order_columns, cursor=None, per_page=20, descending=True):
+    if cursor:
+        values = decode_cursor(cursor, order_columns)
+        query = query.filter(_after(order_columns, values, descending))
+    query = query.order_by(
+        *[c.desc() if descending else c.asc() for c in order_columns]
+    )
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in order_columns])
+    return Page(rows, next_cursor)
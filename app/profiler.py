@@ -0,0 +1,161 @@
+# Opt-in request profiling. A fraction of the requests to selected endpoints,
+# or any request carrying a signed X-Profile header, is profiled and written
+# to PROFILER_DIR: either as collapsed stacks from a thread sampling the
+# request's stack (ready for flamegraph.pl or speedscope), or as cProfile
+# pstats. Nothing is installed unless sampling or the header is switched on,
+# so the profiler costs nothing when it is off.
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = "X-Profile"
+SALT = "profile"
+EXTENSIONS = {"collapsed": ".collapsed", "pstats": ".prof"}
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{code.co_name}"
+
+
+# Samples one thread's stack every `interval` seconds from a helper thread
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _Profile(cProfile.Profile):
+    def start(self):
+        self.enable()
+
+    def stop(self):
+        self.disable()
+
+    def dump(self, path):
+        self.dump_stats(path)
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config["SECRET_KEY"], salt=SALT)
+
+
+# Method for minting an X-Profile header value for one endpoint, or "*" for
+# all of them; it is accepted for PROFILER_TOKEN_MAX_AGE seconds
+def profile_token(app, endpoint="*"):
+    return _serializer(app).dumps(endpoint)
+
+
+def _requested(app):
+    token = request.headers.get(HEADER)
+    if not token or not app.config["PROFILER_HEADER"]:
+        return False
+    try:
+        endpoint = _serializer(app).loads(
+            token, max_age=app.config["PROFILER_TOKEN_MAX_AGE"]
+        )
+    except BadSignature:
+        return False
+    return endpoint in ("*", request.endpoint)
+
+
+def _sampled(app):
+    endpoints = app.config["PROFILER_ENDPOINTS"]
+    if endpoints and request.endpoint not in endpoints:
+        return False
+    return random.random() < app.config["PROFILER_SAMPLE_RATE"]
+
+
+def _start_profile():
+    app = current_app._get_current_object()
+    if request.endpoint is None or not (_sampled(app) or _requested(app)):
+        return
+    if app.config["PROFILER_FORMAT"] == "pstats":
+        profile = _Profile()
+    else:
+        profile = StackSampler(threading.get_ident(), app.config["PROFILER_INTERVAL"])
+    g.profile = (request.endpoint, profile)
+    profile.start()
+
+
+def _finish_profile(exc):
+    endpoint, profile = g.pop("profile", (None, None))
+    if profile is None:
+        return
+    profile.stop()
+    directory = current_app.config["PROFILER_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    name = f"{endpoint}.{time.time_ns()}.{os.getpid()}"
+    extension = EXTENSIONS[current_app.config["PROFILER_FORMAT"]]
+    profile.dump(os.path.join(directory, name + extension))
+
+
+def register_profiler(app):
+    if app.config["PROFILER_SAMPLE_RATE"] <= 0 and not app.config["PROFILER_HEADER"]:
+        return
+    if app.config["PROFILER_FORMAT"] not in EXTENSIONS:
+        raise ValueError(f"Unknown PROFILER_FORMAT {app.config['PROFILER_FORMAT']!r}")
+    app.before_request(_start_profile)
+    app.teardown_request(_finish_profile)
+
+
+# Method for grouping the profile files in a directory by endpoint
+def profile_files(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        if extension in EXTENSIONS.values():
+            endpoint = stem.rsplit(".", 2)[0]
+            files.setdefault(endpoint, []).append(os.path.join(directory, name))
+    return files
+
+
+# Method for merging collapsed stack files into (samples, self counts,
+# inclusive counts) per frame
+def merge_collapsed(paths):
+    samples, own, total = 0, Counter(), Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if not stack:
+                    continue
+                count = int(count)
+                frames = stack.split(";")
+                samples += count
+                own[frames[-1]] += count
+                for frame in set(frames):
+                    total[frame] += count
+    return samples, own, total
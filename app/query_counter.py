@@ -0,0 +1,70 @@
+# Counting the SQL statements a block of code runs, so tests can pin the
+# number of queries an endpoint may make and N+1 regressions fail loudly.
+# Counters nest and are per thread; the engine listener is installed on
+# first use and costs one list lookup per statement when nothing counts.
+import threading
+from contextlib import ContextDecorator
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _record(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_local, "counters", ()):
+        counter.statements.append(statement)
+
+
+# Context manager and decorator collecting the statements run inside it.
+# With a budget, leaving the block after more statements than that raises
+# QueryBudgetExceeded listing them.
+class QueryCounter(ContextDecorator):
+    def __init__(self, budget=None, label=None):
+        self.budget = budget
+        self.label = label
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def _recreate_cm(self):
+        return type(self)(self.budget, self.label)
+
+    def __enter__(self):
+        if not event.contains(Engine, "before_cursor_execute", _record):
+            event.listen(Engine, "before_cursor_execute", _record)
+        self.statements = []
+        if not hasattr(_local, "counters"):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.counters.remove(self)
+        if exc_type is None and self.budget is not None and len(self) > self.budget:
+            raise QueryBudgetExceeded(self.report())
+        return False
+
+    def report(self):
+        lines = [
+            f"{self.label or 'block'} ran {len(self)} statements, "
+            f"budget {self.budget}:"
+        ]
+        lines += [f"  {n}. {s}" for n, s in enumerate(self.statements, 1)]
+        return "\n".join(lines)
+
+
+# Method for counting statements without a limit
+def count_queries(label=None):
+    return QueryCounter(label=label)
+
+
+# Method for failing when the block or function runs more than
+# max_statements statements
+def query_budget(max_statements, label=None):
+    return QueryCounter(max_statements, label)
@@ -0,0 +1,156 @@
+# Compact, schema-versioned snapshots of model rows for the cache. Records
+# are __slots__ objects packed as JSON arrays of column values instead of
+# pickled ORM instances. The version is derived from the packed columns and
+# belongs in every cache key, so entries written before a schema change are
+# simply never read again. Record types also double as projections: they
+# can query just their columns and build records straight from the rows.
+import datetime
+import json
+from hashlib import sha1
+
+from app.extensions import db
+from app.pagination import Page
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+# Forms may assign dates to DateTime columns, the value is normalized on load
+_CODECS = {
+    datetime.datetime: (_isoformat, datetime.datetime.fromisoformat),
+    datetime.date: (_isoformat, datetime.date.fromisoformat),
+}
+
+
+def _identity(value):
+    return value
+
+
+def _codec(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = None
+    return _CODECS.get(python_type, (_identity, _identity))
+
+
+# Base for the generated record classes, repr matches the model's so memoized
+# functions produce the same keys for records and instances
+class Record:
+    __slots__ = ()
+    model = None
+
+    def __repr__(self):
+        return self.model.__repr__(self)
+
+
+# Packs rows of `model` into records of the given columns. `related` maps
+# relationship names to the record types of their targets, `computed` maps
+# extra fields to functions of the instance and `base` lets records inherit
+# behaviour (e.g. Flask-Login's UserMixin).
+class RecordType:
+    def __init__(self, model, fields=None, related=None, computed=None, base=Record):
+        self.model = model
+        attrs = {attr.key: attr for attr in model.__mapper__.column_attrs}
+        self.fields = tuple(fields or attrs)
+        self.codecs = [_codec(attrs[name].columns[0]) for name in self.fields]
+        self.related = dict(related or {})
+        self.computed = dict(computed or {})
+        names = self.fields + tuple(self.computed) + tuple(self.related)
+        self.cls = type(
+            model.__name__ + "Record",
+            (base,) if issubclass(base, Record) else (base, Record),
+            {"__slots__": names, "model": model},
+        )
+
+        signature = [f"{name}:{attrs[name].columns[0].type}" for name in self.fields]
+        signature += list(self.computed)
+        signature += [f"{name}:{rt.version}" for name, rt in self.related.items()]
+        self.version = sha1(
+            f"{model.__tablename__}({','.join(signature)})".encode()
+        ).hexdigest()[:8]
+
+    def pack(self, instance):
+        row = [
+            None if value is None else encode(value)
+            for value, (encode, _) in zip(
+                (getattr(instance, name) for name in self.fields), self.codecs
+            )
+        ]
+        row += [f(instance) for f in self.computed.values()]
+        row += [
+            record_type.pack(getattr(instance, name))
+            for name, record_type in self.related.items()
+        ]
+        return row
+
+    def unpack(self, row):
+        record = self.cls.__new__(self.cls)
+        values = iter(row)
+        for name, (_, decode), value in zip(self.fields, self.codecs, values):
+            setattr(record, name, None if value is None else decode(value))
+        for name in self.computed:
+            setattr(record, name, next(values))
+        for name, record_type in self.related.items():
+            setattr(record, name, record_type.unpack(next(values)))
+        return record
+
+    def from_instance(self, instance):
+        return self.unpack(self.pack(instance))
+
+    # Query selecting only the record's columns, related rows are joined in
+    # under "<relationship>__<column>" labels
+    def query(self):
+        columns = [getattr(self.model, name) for name in self.fields]
+        for name, record_type in self.related.items():
+            columns += [
+                getattr(record_type.model, field).label(f"{name}__{field}")
+                for field in record_type.fields
+            ]
+        query = db.session.query(*columns)
+        for name in self.related:
+            query = query.join(getattr(self.model, name))
+        return query
+
+    def from_row(self, row):
+        return self._from_values(iter(row))
+
+    def _from_values(self, values):
+        if self.computed:
+            raise TypeError(f"{self.cls.__name__} has computed fields")
+        record = self.cls.__new__(self.cls)
+        for name in self.fields:
+            setattr(record, name, next(values))
+        for name, record_type in self.related.items():
+            setattr(record, name, record_type._from_values(values))
+        return record
+
+    def dumps(self, instance):
+        return json.dumps(self.pack(instance), separators=(",", ":")).encode()
+
+    def loads(self, payload):
+        return self.unpack(json.loads(payload))
+
+
+# Method for querying only the given columns of a model as read-only rows,
+# e.g. for tables rendering every row of a model
+def project(model, columns):
+    return db.session.query(*[getattr(model, column) for column in columns])
+
+
+# Codec for pagination.Page results made of one record type
+class PageCodec:
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self.version = record_type.version
+
+    def dumps(self, page):
+        return json.dumps(
+            [page.next_cursor, [self.record_type.pack(item) for item in page.items]],
+            separators=(",", ":"),
+        ).encode()
+
+    def loads(self, payload):
+        next_cursor, rows = json.loads(payload)
+        return Page([self.record_type.unpack(row) for row in rows], next_cursor)
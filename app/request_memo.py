@@ -0,0 +1,74 @@
+# Request-scoped memo for lookups by unique key (email, username, slug, id).
+# Forms, views and templates that need the same row within one request share
+# a single query or cache read through it. Entries live on `g` under the
+# model they came from; a flush writing a row of that model forgets them,
+# and they are cleared when the request ends. Outside requests every lookup
+# goes straight to the loader.
+from flask import g, has_request_context
+from sqlalchemy import event, or_
+
+from app.extensions import db
+
+# Marker for memoized misses, so unknown keys are not looked up again
+_NONE = object()
+
+
+def _entries(model):
+    if not has_request_context():
+        return None
+    if "request_memo" not in g:
+        g.request_memo = {}
+    return g.request_memo.setdefault(model, {})
+
+
+# Method for answering `load()` once per request for the given model and key
+def memoized(model, key, load):
+    entries = _entries(model)
+    if entries is None:
+        return load()
+    value = entries.get(key)
+    if value is None:
+        value = load()
+        entries[key] = _NONE if value is None else value
+    return None if value is _NONE else value
+
+
+# Method for the row of model whose unique column equals value, or None
+def lookup(model, column, value):
+    return memoized(
+        model,
+        (column, value),
+        lambda: model.query.filter_by(**{column: value}).first(),
+    )
+
+
+# Method for looking rows up by several unique columns in one query, e.g.
+# the username and email of a registration; later lookups hit the memo
+def preload(model, **values):
+    entries = _entries(model)
+    values = {column: value for column, value in values.items() if value}
+    if entries is None or not values:
+        return
+    criteria = [getattr(model, column) == value for column, value in values.items()]
+    rows = model.query.filter(or_(*criteria)).all()
+    for column, value in values.items():
+        found = [row for row in rows if getattr(row, column) == value]
+        entries[(column, value)] = found[0] if found else _NONE
+
+
+def _forget_written(session, flush_context):
+    memo = g.get("request_memo") if has_request_context() else None
+    if not memo:
+        return
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        memo.pop(type(instance), None)
+
+
+def _clear(exc):
+    g.pop("request_memo", None)
+
+
+def register_request_memo(app):
+    if not event.contains(db.session, "after_flush", _forget_written):
+        event.listen(db.session, "after_flush", _forget_written)
+    app.teardown_request(_clear)
@@ -0,0 +1,176 @@
+# Full-text search over albums and tours. SQLite uses an FTS5 virtual table,
+# PostgreSQL a table with a weighted tsvector column behind a GIN index.
+# Documents are keyed by doc_id = id * 2 + kind, so updates hit the key
+# instead of scanning the index.
+import re
+
+from sqlalchemy import DDL, column, event, inspect, select, table, text
+from sqlalchemy.engine.url import make_url
+
+from app import db
+from app.caching import on_cascade_delete, on_change
+from app.models import Album, Tour
+
+KINDS = {Album: 0, Tour: 1}
+FIELDS = ["title", "artist", "description", "genre"]
+
+CREATE_INDEX = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "title, artist, description, genre, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    ],
+    "postgresql": [
+        "CREATE TABLE IF NOT EXISTS search_index ("
+        "doc_id BIGINT PRIMARY KEY, "
+        "title TEXT, artist TEXT, description TEXT, genre TEXT, "
+        "document TSVECTOR GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(artist, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(genre, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'C')"
+        ") STORED)",
+        "CREATE INDEX IF NOT EXISTS ix_search_index_document "
+        "ON search_index USING GIN (document)",
+    ],
+}
+KEY_COLUMN = {"sqlite": "rowid", "postgresql": "doc_id"}
+
+# The index is created and dropped together with the mapped tables
+for dialect, statements in CREATE_INDEX.items():
+    for statement in statements:
+        event.listen(
+            db.metadata, "after_create", DDL(statement).execute_if(dialect=dialect)
+        )
+event.listen(db.metadata, "after_drop", DDL("DROP TABLE IF EXISTS search_index"))
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+# Every write to albums and tours goes through the index, so other databases
+# are refused when the app is created rather than on the first write
+def register_search(app):
+    dialect = make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name()
+    if dialect not in KEY_COLUMN:
+        raise ValueError(f"Full-text search does not support {dialect!r} databases")
+
+
+def doc_id(instance):
+    return instance.id * 2 + KINDS[type(instance)]
+
+
+def _remove(doc_ids):
+    key = KEY_COLUMN[_dialect()]
+    for doc in doc_ids:
+        db.session.execute(
+            text(f"DELETE FROM search_index WHERE {key} = :doc"), {"doc": doc}
+        )
+
+
+def _add(instance):
+    key = KEY_COLUMN[_dialect()]
+    db.session.execute(
+        text(
+            f"INSERT INTO search_index ({key}, {', '.join(FIELDS)}) "
+            f"VALUES (:doc, {', '.join(':' + f for f in FIELDS)})"
+        ),
+        dict({f: getattr(instance, f) for f in FIELDS}, doc=doc_id(instance)),
+    )
+
+
+# The index is updated in the same transaction as the rows it mirrors
+@on_change(Album, Tour)
+def update_search_index(instance, state, pending):
+    if state == "dirty":
+        attrs = inspect(instance).attrs
+        if not any(attrs[f].history.has_changes() for f in FIELDS):
+            return
+    if state != "new":
+        _remove([doc_id(instance)])
+    if state != "deleted":
+        _add(instance)
+
+
+# Rows removed by ON DELETE CASCADE leave the index in one statement
+@on_cascade_delete(Album, Tour)
+def remove_cascaded_documents(model, criterion, pending):
+    key = column(KEY_COLUMN[_dialect()])
+    documents = select([model.id * 2 + KINDS[model]]).where(criterion)
+    db.session.execute(table("search_index", key).delete().where(key.in_(documents)))
+
+
+# Method for indexing the rows of model matching criterion (all rows when
+# it is None) with a single INSERT ... SELECT
+def index_documents(model, criterion=None):
+    key = KEY_COLUMN[_dialect()]
+    documents = select(
+        [model.id * 2 + KINDS[model]] + [getattr(model, f) for f in FIELDS]
+    )
+    if criterion is not None:
+        documents = documents.where(criterion)
+    index = table("search_index", *[column(name) for name in [key] + FIELDS])
+    db.session.execute(index.insert().from_select([key] + FIELDS, documents))
+
+
+# Method for rebuilding the whole index from the albums and tours tables
+def rebuild_index():
+    db.session.execute(text("DELETE FROM search_index"))
+    for model in KINDS:
+        index_documents(model)
+    if _dialect() == "sqlite":
+        db.session.execute(
+            text("INSERT INTO search_index (search_index) VALUES ('optimize')")
+        )
+    db.session.commit()
+
+
+# Every word of the user's input becomes a quoted prefix term, so FTS5
+# operators in the input are matched literally
+def _match_expression(query):
+    terms = re.findall(r"\w+", query)
+    return " ".join('"{}"*'.format(term) for term in terms)
+
+
+def _ranked_doc_ids(query, limit, offset):
+    if _dialect() == "sqlite":
+        expression = _match_expression(query)
+        if not expression:
+            return []
+        rows = db.session.execute(
+            text(
+                "SELECT rowid FROM search_index WHERE search_index MATCH :q "
+                "ORDER BY bm25(search_index, 10.0, 10.0, 1.0, 5.0) "
+                "LIMIT :limit OFFSET :offset"
+            ),
+            {"q": expression, "limit": limit, "offset": offset},
+        )
+    else:
+        rows = db.session.execute(
+            text(
+                "SELECT doc_id FROM search_index, "
+                "plainto_tsquery('simple', :q) AS query "
+                "WHERE document @@ query "
+                "ORDER BY ts_rank(document, query) DESC "
+                "LIMIT :limit OFFSET :offset"
+            ),
+            {"q": query, "limit": limit, "offset": offset},
+        )
+    return [row[0] for row in rows]
+
+
+# Method for searching albums and tours, returns one page of ranked results
+# and whether there is a next page
+def search(query, page=1, per_page=20):
+    doc_ids = _ranked_doc_ids(query, per_page + 1, (page - 1) * per_page)
+    has_next = len(doc_ids) > per_page
+    doc_ids = doc_ids[:per_page]
+
+    found = {}
+    for model, kind in KINDS.items():
+        ids = [doc // 2 for doc in doc_ids if doc % 2 == kind]
+        if ids:
+            for instance in model.query.filter(model.id.in_(ids)):
+                found[doc_id(instance)] = instance
+    return [found[doc] for doc in doc_ids if doc in found], has_next
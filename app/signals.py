@@ -1,22 +1,37 @@
+import random
+
 from flask.signals import Namespace
-from flask import template_rendered
+from flask import current_app, has_request_context, request, template_rendered
+
+from app.event_log import event_log, summarize
 
 custom_namespace = Namespace()
 admin_deleted = custom_namespace.signal("admin_deleted")
 
 def log_template_renders(sender, template, context, **extra):
-    print("Rendering template {}".format(
-        template.name or "template string"
-    ))
-    print("with context: {}".format(str(context)))
+    if random.random() >= current_app.config["TEMPLATE_LOG_SAMPLE_RATE"]:
+        return
+    event_log.emit(
+        "template_rendered",
+        template=template.name or "template string",
+        endpoint=request.endpoint if has_request_context() else None,
+        context={
+            key: summarize(value)
+            for key, value in context.items()
+            if key not in sender.jinja_env.globals
+        },
+    )
 
 def log_admin_deletion(senderm, a_name, r_name, r_id, **kw):
-    print("{} with id {} was deleted by {}". format(
-        r_name.capitalize(),
-        str(r_id),
-        a_name
-    ))
+    if random.random() >= current_app.config["ADMIN_LOG_SAMPLE_RATE"]:
+        return
+    event_log.emit(
+        "admin_deleted",
+        admin=a_name,
+        resource=r_name,
+        resource_id=r_id,
+    )
 
 def register_signals(app):
     admin_deleted.connect(log_admin_deletion, app)
-    template_rendered.connect(log_template_renders, app)
\ No newline at end of file
+    template_rendered.connect(log_template_renders, app)
@@ -0,0 +1,63 @@
+# Read-through cache resolving slugs to row snapshots, with negative entries
+# for unknown slugs so 404 floods never reach the database
+from sqlalchemy import inspect
+
+from app import db
+from app.caching import SAFETY_TIMEOUT, get_or_set, on_cascade_delete, on_change
+from app.models import ALBUM_SNAPSHOT, TOUR_SNAPSHOT, Album, Tour
+from app.request_memo import memoized
+
+# Marker cached for slugs that do not exist
+MISSING = "missing"
+# Negative entries are cheap to rebuild, keep them short-lived
+NEGATIVE_TIMEOUT = 5 * 60
+# Cached snapshot layout of each model
+SNAPSHOTS = {Album: ALBUM_SNAPSHOT, Tour: TOUR_SNAPSHOT}
+
+
+def slug_key(model, slug):
+    return f"slug:{model.__tablename__}:{SNAPSHOTS[model].version}:{slug}"
+
+
+# Method for resolving a slug to a snapshot, or None for unknown slugs;
+# repeated calls within a request are answered from the request memo
+def resolve_slug(model, slug):
+    return memoized(model, ("slug", slug), lambda: _resolve_slug(model, slug))
+
+
+def _resolve_slug(model, slug):
+    def load():
+        instance = model.query.filter_by(slug=slug).first()
+        return SNAPSHOTS[model].dumps(instance) if instance else MISSING
+
+    payload = get_or_set(
+        slug_key(model, slug),
+        load,
+        timeout=lambda payload: (
+            NEGATIVE_TIMEOUT if payload == MISSING else SAFETY_TIMEOUT
+        ),
+    )
+    if payload == MISSING:
+        return None
+    return SNAPSHOTS[model].loads(payload)
+
+
+# Slug entries are rebuilt on create and update, and the old slug is dropped
+# when update_slug rewrote it on a title change
+@on_change(Album, Tour)
+def refresh_slug_entries(instance, state, pending):
+    model = type(instance)
+    for old_slug in inspect(instance).attrs.slug.history.deleted:
+        if old_slug:
+            pending.keys.add(slug_key(model, old_slug))
+    key = slug_key(model, instance.slug)
+    if state == "deleted":
+        pending.keys.add(key)
+    else:
+        pending.values[key] = SNAPSHOTS[model].dumps(instance)
+
+
+@on_cascade_delete(Album, Tour)
+def drop_cascaded_slug_entries(model, criterion, pending):
+    for (slug,) in db.session.query(model.slug).filter(criterion):
+        pending.keys.add(slug_key(model, slug))
@@ -0,0 +1,160 @@
+# Content-addressed upload storage: files are stored once under a fanned-out
+# path derived from their SHA-256, and reference counted by the albums using
+# them, so identical covers share a file. Files that lost their last
+# reference stay on disk until `flask images gc` removes them after a grace
+# period, so an upload of the same content in flight never loses its file.
+import os
+import re
+import tempfile
+from collections import Counter
+from hashlib import sha256
+
+from sqlalchemy import func, inspect, select, text
+
+from app import db
+from app.caching import on_cascade_delete, on_change
+from app.images import VARIANTS, InvalidImage, derivative_name, generate_derivatives
+from app.images import has_derivatives, is_derivative
+from app.models import Album, StoredFile
+
+CHUNK_SIZE = 64 * 1024
+CONTENT_PATH = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$")
+
+
+def content_path(digest, extension):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}"
+
+
+def is_content_path(filename):
+    return bool(CONTENT_PATH.match(filename))
+
+
+# Method for streaming a file into the store while hashing it, returns the
+# relative path and whether the content was new
+def store_stream(directory, stream, extension):
+    digest = sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        filename = content_path(digest.hexdigest(), extension)
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # A fresh mtime keeps gc off the file until the upload commits
+            os.utime(path)
+            return filename, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return filename, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Method for storing a local file the way uploads are stored, returns the
+# stored path and the error that prevented its resized variants, if any.
+# Files Pillow can not decode raise InvalidImage and are not kept.
+def ingest_file(directory, path):
+    with open(path, "rb") as f:
+        filename, created = store_stream(directory, f, os.path.splitext(path)[1])
+    if created or not has_derivatives(directory, filename):
+        try:
+            generate_derivatives(directory, filename)
+        except InvalidImage:
+            if created:
+                remove_files(directory, [filename])
+            raise
+        except OSError as e:
+            return filename, str(e)
+    return filename, None
+
+
+# Method for listing the originals in the upload directory, as relative paths
+def list_uploads(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.relpath(os.path.join(root, name), directory)
+            filename = filename.replace(os.sep, "/")
+            if not is_derivative(filename) and not name.endswith(".tmp"):
+                yield filename
+
+
+def remove_files(directory, filenames):
+    for filename in filenames:
+        for name in [filename] + [derivative_name(filename, v) for v in VARIANTS]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+# Method for adding many references at once, counts maps paths to the
+# number of new references
+def acquire_many(counts):
+    db.session.execute(
+        text(
+            "INSERT INTO stored_files (path, refcount) VALUES (:path, :count) "
+            "ON CONFLICT (path) DO UPDATE "
+            "SET refcount = stored_files.refcount + excluded.refcount"
+        ),
+        [{"path": path, "count": count} for path, count in counts.items()],
+    )
+
+
+def _release(filename):
+    table = StoredFile.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.path == filename)
+        .values(refcount=table.c.refcount - 1)
+    )
+    db.session.execute(
+        table.delete().where(table.c.path == filename).where(table.c.refcount <= 0)
+    )
+
+
+# Reference counts move with the albums; the upsert lets two first uploads
+# of the same content reference it concurrently
+@on_change(Album)
+def track_image_references(album, state, pending):
+    history = inspect(album).attrs.image.history
+    if state == "new":
+        acquired, released = [album.image], []
+    elif state == "deleted":
+        acquired, released = [], [album.image]
+    else:
+        acquired, released = history.added, history.deleted
+
+    if acquired:
+        acquire_many(Counter(acquired))
+    for filename in released:
+        if filename:
+            _release(filename)
+
+
+# Albums removed with their user give up their references in two
+# statements, however many there are
+@on_cascade_delete(Album)
+def release_cascaded_images(model, criterion, pending):
+    table = StoredFile.__table__
+    images = select([Album.image]).where(criterion)
+    references = (
+        select([func.count()])
+        .where(criterion)
+        .where(Album.image == table.c.path)
+        .correlate(table)
+        .as_scalar()
+    )
+    db.session.execute(
+        table.update()
+        .where(table.c.path.in_(images))
+        .values(refcount=table.c.refcount - references)
+    )
+    db.session.execute(
+        table.delete().where(table.c.path.in_(images) & (table.c.refcount <= 0))
+    )
@@ -70,6 +70,10 @@ class TourForm(FlaskForm):
         format="%Y-%m-%d",
     )
 
+    # The admin's bulk update only sets the dates together, so the rule
+    # below always sees both of them
+    bulk_together = [("start_date", "end_date")]
+
     def validate_start_date(form, field):
         if field.data > form.end_date.data:
             raise ValidationError("Start date needs to be before the end date.")
@@ -1,5 +1,5 @@
 # Imports from flask
-from flask import render_template, redirect, url_for, flash, abort, Blueprint
+from flask import render_template, redirect, request, url_for, flash, abort, Blueprint, current_app
 # Extension for implementing Flask-Login for authentication
 from flask_login import login_required, current_user
 # Extension for implementing translations
@@ -7,18 +7,65 @@ from flask_babel import _
 from flask_babel import lazy_gettext as _l
 # Imports from the app package
 from app import db
-from app.models import Tour
+from app.caching import fragment_keys, memoize_in, on_cascade_delete, on_change
+from app.models import TOUR_CARD, Tour, User
+from app.pagination import InvalidCursor, Page, keyset_paginate
+from app.records import PageCodec
+from app.slug_cache import resolve_slug
+from sqlalchemy import inspect
 
 from app.tour.forms import CreateTourForm, UpdateTourForm
 
 tour = Blueprint("tour", __name__, template_folder="templates")
 
+# Every page is memoized under its own cursor, so a miss only loads one page
+@memoize_in("tours", codec=PageCodec(TOUR_CARD))
+def get_tours(cursor=None):
+    # Only the columns the cards show are loaded, straight into records
+    page = keyset_paginate(
+        TOUR_CARD.query(),
+        [Tour.start_date, Tour.id],
+        cursor=cursor,
+        per_page=current_app.config["ITEMS_PER_PAGE"],
+    )
+    return Page([TOUR_CARD.from_row(row) for row in page.items], page.next_cursor)
+
+# List pages show tour data and the owner's username
+@on_change(Tour, User)
+def invalidate_tour_pages(instance, state, pending):
+    if isinstance(instance, Tour) or state == "deleted" or (
+        inspect(instance).attrs.username.history.has_changes()
+    ):
+        pending.namespaces.add("tours")
+
+# Fragments are keyed by row version, so an edited tour misses on its own;
+# the stale version is dropped to free the cache
+@on_change(Tour)
+def drop_tour_fragments(tour, state, pending):
+    if state != "new":
+        version = tour.version if state == "deleted" else tour.version - 1
+        pending.keys.update(
+            fragment_keys(("tour_card", "tour_detail"), tour.id, version)
+        )
+
+# Tours removed together with their user
+@on_cascade_delete(Tour)
+def drop_cascaded_tour_fragments(model, criterion, pending):
+    pending.namespaces.add("tours")
+    for id, version in db.session.query(Tour.id, Tour.version).filter(criterion):
+        pending.keys.update(fragment_keys(("tour_card", "tour_detail"), id, version))
+
 # Route for listing tours
 @tour.route("/")
 @login_required
 def list():
-    tours = Tour.query.all()
-    return render_template("list_tours.html", tours=tours)
+    try:
+        page = get_tours(request.args.get("after"))
+    except InvalidCursor:
+        abort(404)
+    return render_template(
+        "list_tours.html", tours=page.items, next_cursor=page.next_cursor
+    )
 
 
 # Route for creating new tours
@@ -52,11 +99,12 @@ def create():
 def edit(slug):
     form = UpdateTourForm()
 
-    tour = Tour.query.filter_by(slug=slug).first()
+    snapshot = resolve_slug(Tour, slug)
 
-    if not tour or not current_user.is_tour_owner(tour):
+    if not snapshot or not current_user.is_tour_owner(snapshot):
         flash(_("You are not authorized to do this."), "danger")
         return redirect(url_for("main.home"))
+    tour = Tour.query.get_or_404(snapshot.id)
 
     if form.validate_on_submit():
         title = form.title.data
@@ -91,10 +139,11 @@ def edit(slug):
 @tour.route("/tour/delete/<slug>", methods=["POST"])
 @login_required
 def delete(slug):
-    tour = Tour.query.filter_by(slug=slug).first()
-    if not tour or not current_user.is_tour_owner(tour):
+    snapshot = resolve_slug(Tour, slug)
+    if not snapshot or not current_user.is_tour_owner(snapshot):
         flash(_("You are not authorized to do this."), "danger")
         return redirect(url_for("main.home"))
+    tour = Tour.query.get_or_404(snapshot.id)
     db.session.delete(tour)
     db.session.commit()
     flash(_("The tour has been deleted."), "success")
@@ -105,7 +154,7 @@ def delete(slug):
 @tour.route("/tour/show/<slug>")
 @login_required
 def show(slug):
-    tour = Tour.query.filter_by(slug=slug).first()
+    tour = resolve_slug(Tour, slug)
     if not tour:
         abort(404)
     return render_template("show_tour.html", tour=tour)
@@ -6,18 +6,20 @@ url_processors = Blueprint("url_processors", __name__)
 def before_request():
     # Not really a URL processor, but we will still
     # put it her for convenience
-    if request.endpoint is "static":
+    if request.endpoint is None or request.endpoint == "static":
         return
+    # Only a changed language sets the cookie, responses without Set-Cookie
+    # stay cacheable by proxies
     if request.cookies.get("lang") != g.lang:
         @after_this_request
         def set_cookie(response):
-            response. set_cookie("lang", g.lang, max_age=60*60*24*100)
+            response.set_cookie("lang", g.lang, max_age=60*60*24*100)
             return response
 
 @url_processors.app_url_value_preprocessor
 def processor(endpoint, values):
     try:
-        if endpoint is "static":
+        if endpoint == "static":
             return
         g.lang = values.pop("lang")
     except:
@@ -0,0 +1,186 @@
+"""Drives the key endpoints through the test client against a seeded catalog.
+
+For every endpoint it reports p50/p95/p99 latency, SQL statements per request
+and the peak memory allocated while serving a request. With --baseline it
+exits with status 1 when an endpoint runs more statements than the baseline,
+or its p95 grows by more than --threshold. Latencies only compare on the
+machine that wrote the baseline; re-save it there with --save-baseline.
+
+Run from the project root with `python -m benchmarks.endpoints`.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.event_log import event_log
+from benchmarks.seed import PASSWORD, seed
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+MEMORY_REQUESTS = 5
+
+
+def endpoints(usernames, albums, tours):
+    album, tour = albums[len(albums) // 2], tours[len(tours) // 2]
+    login = {"email": f"{usernames[-1]}@example.com", "password": PASSWORD}
+    return [
+        ("main.home", "GET", "/en/", None, "anonymous"),
+        ("album.list", "GET", "/en/album/", None, "admin"),
+        ("album.show", "GET", f"/en/album/show/{album}", None, "admin"),
+        ("tour.list", "GET", "/en/tour/", None, "admin"),
+        ("tour.show", "GET", f"/en/tour/tour/show/{tour}", None, "admin"),
+        ("main.search", "GET", "/en/search?q=night", None, "admin"),
+        ("admin.album_table", "GET", "/en/admin/album/", None, "admin"),
+        ("admin.tour_table", "GET", "/en/admin/tour/", None, "admin"),
+        ("admin.user_table", "GET", "/en/admin/user/", None, "admin"),
+        ("auth.login", "POST", "/en/login", login, "fresh"),
+    ]
+
+
+def percentile(samples, q):
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+def measure(app, clients, statements, endpoint, requests, warmup):
+    name, method, path, data, session = endpoint
+
+    def call():
+        # Logins need a client without a session every time
+        client = app.test_client() if session == "fresh" else clients[session]
+        response = client.open(path, method=method, data=data)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{name}: {method} {path} -> {response.status}")
+
+    for _ in range(warmup):
+        call()
+    statements.clear()
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    queries = len(statements) / requests
+
+    peak = 0
+    for _ in range(MEMORY_REQUESTS):
+        tracemalloc.start()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+        "queries": queries,
+        "peak_kib": peak / 1024,
+    }
+
+
+def regressions(results, baseline, threshold):
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["queries"] > expected["queries"]:
+            failures.append(
+                f"{name}: {result['queries']:.2f} queries/request, "
+                f"baseline {expected['queries']:.2f}"
+            )
+        if result["p95"] > expected["p95"] * (1 + threshold):
+            failures.append(
+                f"{name}: p95 {result['p95']:.2f}ms, "
+                f"baseline {expected['p95']:.2f}ms (+{threshold:.0%} allowed)"
+            )
+    return failures
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--albums", type=int, default=2000)
+    parser.add_argument("--tours", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=200, help="Per endpoint")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests")
+    parser.add_argument("--only", action="append", help="Endpoint to run")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Sampled render events go to stderr, stdout is left to the report
+    event_log.stream = sys.stderr
+    app = create_app("testing")
+    handle, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["IMAGE_UPLOADS"] = tempfile.mkdtemp()
+    statements = []
+
+    with app.app_context():
+        db.create_all()
+        event.listen(
+            db.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *rest: statements.append(statement),
+        )
+        seeded = seed(args.users, args.albums, args.tours)
+        db.session.remove()
+
+    # Requests run without an outer app context, so every request gets a fresh
+    # session the way it does in production
+    clients = {"anonymous": app.test_client(), "admin": app.test_client()}
+    clients["admin"].post(
+        "/en/login", data={"email": "admin@example.com", "password": PASSWORD}
+    )
+
+    results = {}
+    print(
+        f"{'endpoint':<20}{'p50':>8}{'p95':>8}{'p99':>8}{'queries':>9}{'peak KiB':>10}"
+    )
+    for endpoint in endpoints(*seeded):
+        if args.only and endpoint[0] not in args.only:
+            continue
+        result = measure(
+            app, clients, statements, endpoint, args.requests, args.warmup
+        )
+        results[endpoint[0]] = result
+        print(
+            f"{endpoint[0]:<20}{result['p50']:>8.2f}{result['p95']:>8.2f}"
+            f"{result['p99']:>8.2f}{result['queries']:>9.2f}{result['peak_kib']:>10.0f}"
+        )
+
+    with app.app_context():
+        db.drop_all()
+    os.remove(path)
+    shutil.rmtree(app.config["IMAGE_UPLOADS"])
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved the baseline to {args.baseline}.")
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        failures = regressions(results, json.load(f), args.threshold)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Measures the queries and time load_user costs per authenticated request.
+
+Run from the project root with `python -m benchmarks.load_user`.
+"""
+import time
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import User
+
+REQUESTS = 500
+
+
+def run(client, statements, path):
+    statements.clear()
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get(path)
+    elapsed = time.perf_counter() - start
+    return len(statements) / REQUESTS, elapsed / REQUESTS * 1000
+
+
+def main():
+    app = create_app("testing")
+    statements = []
+    with app.app_context():
+        db.create_all()
+        event.listen(
+            db.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        db.session.add(User("benchmark", "benchmark@gmail.com", "password123"))
+        db.session.commit()
+
+    # Requests run without an outer app context, so every request gets a fresh
+    # session the way it does in production
+    client = app.test_client()
+    client.post(
+        "/en/login",
+        data={"email": "benchmark@gmail.com", "password": "password123"},
+    )
+
+    # The home page runs no queries of its own for authenticated users
+    cached = run(client, statements, "/en/")
+    original = app.login_manager._user_callback
+    app.login_manager.user_loader(
+        lambda user_id: User.query.get(int(user_id.partition(":")[0]))
+    )
+    uncached = run(client, statements, "/en/")
+    app.login_manager.user_loader(original)
+
+    print(f"{'':>12}{'queries/req':>14}{'ms/req':>10}")
+    print(f"{'DB lookup':>12}{uncached[0]:>14.2f}{uncached[1]:>10.3f}")
+    print(f"{'cached':>12}{cached[0]:>14.2f}{cached[1]:>10.3f}")
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
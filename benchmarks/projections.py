@@ -0,0 +1,87 @@
+"""Compares loading a 100k-row albums table as ORM entities and as projections.
+
+Run from the project root with `python -m benchmarks.projections`.
+"""
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+from app import create_app, db
+from app.models import ALBUM_CARD, Album, User
+from app.records import project
+
+ROWS = 100_000
+BATCH = 10_000
+
+
+def seed():
+    db.session.add(User("benchmark", "benchmark@gmail.com", "password123"))
+    db.session.commit()
+    start = datetime.datetime(2000, 1, 1)
+    for offset in range(0, ROWS, BATCH):
+        db.session.execute(
+            Album.__table__.insert(),
+            [
+                {
+                    "title": f"Album {i}",
+                    "artist": f"Artist {i % 500}",
+                    "description": "A fairly ordinary description " * 4,
+                    "genre": "Rock",
+                    "image": "cover.png",
+                    "release_date": start + datetime.timedelta(hours=i),
+                    "user_id": 1,
+                    "slug": f"album-{i}",
+                    "version": 1,
+                }
+                for i in range(offset, min(offset + BATCH, ROWS))
+            ],
+        )
+    db.session.commit()
+
+
+def measure(load):
+    db.session.remove()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = load()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert len(rows) == ROWS
+    return elapsed * 1000, peak / 2 ** 20
+
+
+def main():
+    app = create_app("testing")
+    handle, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    columns = Album.__mapper__.columns.keys()
+
+    with app.app_context():
+        db.create_all()
+        seed()
+        cases = [
+            ("entities", lambda: Album.query.all()),
+            ("projection", lambda: project(Album, columns).all()),
+            (
+                "card entities",
+                lambda: Album.query.options(db.joinedload(Album.user)).all(),
+            ),
+            (
+                "card records",
+                lambda: [ALBUM_CARD.from_row(row) for row in ALBUM_CARD.query()],
+            ),
+        ]
+        print(f"{ROWS} rows{'ms':>14}{'peak MiB':>10}")
+        for name, load in cases:
+            elapsed, peak = measure(load)
+            print(f"{name:>14}{elapsed:>10.0f}{peak:>10.1f}")
+        db.session.remove()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
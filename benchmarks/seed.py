@@ -0,0 +1,119 @@
+"""Fills a database with a synthetic catalog for the benchmarks.
+
+Users share one password hash ("password123") and the first one is an admin.
+Albums and tours get titles, artists and descriptions of realistic length
+drawn from a fixed vocabulary, and albums use a handful of generated covers
+stored the way uploads are, so every run with the same seed is identical.
+"""
+import datetime
+import os
+import random
+import tempfile
+from collections import Counter
+
+from flask import current_app
+from PIL import Image
+
+from app import db
+from app.models import Album, Tour, User
+from app.search import index_documents
+from app.storage import acquire_many, ingest_file
+
+PASSWORD = "password123"
+GENRES = ["Rock", "Pop", "Jazz", "Blues", "Metal", "Folk", "Electronic", "Soul"]
+WORDS = (
+    "night summer river light electric golden broken silent wild blue road "
+    "heart city fire dream stone echo velvet shadow morning ocean thunder "
+    "glass paper midnight garden mirror island radio winter neon desert "
+    "highway storm silver crowd orchestra ballad anthem chorus rhythm stage "
+    "live session acoustic revival tape vinyl remaster deluxe edition tour"
+).split()
+BATCH = 1000
+
+
+def _words(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _covers(directory, count, rng):
+    source = tempfile.mkdtemp()
+    covers = []
+    for i in range(count):
+        path = os.path.join(source, f"cover-{i}.png")
+        color = tuple(rng.randrange(256) for _ in range(3))
+        Image.new("RGB", (800, 800), color).save(path)
+        covers.append(ingest_file(directory, path)[0])
+        os.remove(path)
+    os.rmdir(source)
+    return covers
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(model.__table__.insert(), rows[start : start + BATCH])
+
+
+# Method for seeding the current app's database, returns the seeded users
+# (the admin first), album slugs and tour slugs
+def seed(users=50, albums=2000, tours=500, covers=8, random_seed=0):
+    rng = random.Random(random_seed)
+    password_hash = User(password=PASSWORD).password_hash
+    usernames = ["admin"] + [f"user{i}" for i in range(1, users)]
+    _insert(
+        User,
+        [
+            {
+                "username": username,
+                "email": f"{username}@example.com",
+                "password_hash": password_hash,
+                "is_admin": username == "admin",
+            }
+            for username in usernames
+        ],
+    )
+
+    images = _covers(current_app.config["IMAGE_UPLOADS"], covers, rng)
+    start = datetime.datetime(2000, 1, 1)
+    album_rows = [
+        {
+            "title": f"{_words(rng, 1, 4).title()} {i}",
+            "artist": _words(rng, 1, 3).title(),
+            "description": _words(rng, 40, 120).capitalize() + ".",
+            "genre": rng.choice(GENRES),
+            "image": rng.choice(images),
+            "release_date": start + datetime.timedelta(days=rng.randrange(8000)),
+            "user_id": rng.randint(1, users),
+            "slug": f"album-{i}",
+            "version": 1,
+        }
+        for i in range(albums)
+    ]
+    _insert(Album, album_rows)
+    acquire_many(Counter(row["image"] for row in album_rows))
+
+    tour_rows = []
+    for i in range(tours):
+        start_date = start + datetime.timedelta(days=rng.randrange(8000))
+        tour_rows.append(
+            {
+                "title": f"{_words(rng, 1, 4).title()} Tour {i}",
+                "artist": _words(rng, 1, 3).title(),
+                "description": _words(rng, 40, 120).capitalize() + ".",
+                "genre": rng.choice(GENRES),
+                "start_date": start_date,
+                "end_date": start_date + datetime.timedelta(days=rng.randint(7, 120)),
+                "user_id": rng.randint(1, users),
+                "slug": f"tour-{i}",
+                "version": 1,
+            }
+        )
+    _insert(Tour, tour_rows)
+
+    for model in (Album, Tour):
+        index_documents(model)
+    db.session.commit()
+    return (
+        usernames,
+        [row["slug"] for row in album_rows],
+        [row["slug"] for row in tour_rows],
+    )
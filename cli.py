@@ -1,10 +1,34 @@
 import click
+import io
 import os
+import pstats
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from flask import current_app
 from flask.cli import with_appcontext
 from app import db
-from app.models import User
+from app.catalog import (
+    InvalidDump,
+    dump_catalog,
+    import_records,
+    import_users,
+    read_checkpoint,
+    read_records,
+    restore_catalog,
+    write_checkpoint,
+)
+from app.metrics import collect, render_text
+from app.profiler import merge_collapsed, profile_files, profile_token
+from app.images import generate_derivatives, has_derivatives
+from app.models import Album, StoredFile, Tour, User
+from app.search import rebuild_index
+from app.storage import (
+    is_content_path,
+    list_uploads,
+    remove_files,
+    store_stream,
+)
 
 
 @click.command("test")
@@ -22,6 +46,13 @@ def list_bp_endpoints(blueprint):
             click.echo(endpoint)
 
 
+@click.command("metrics")
+@with_appcontext
+def metrics():
+    """This command prints the metrics published by all of the app workers"""
+    click.echo(render_text(collect()), nl=False)
+
+
 @click.group("user")
 def user():
     pass
@@ -74,7 +105,338 @@ def create(username, email, password, admin):
         db.session.rollback()
 
 
+@user.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("-b", "--batch-size", default=500, help="Users per insert")
+@click.option("-w", "--workers", type=int, help="Password hashing processes")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of a previous run")
+@with_appcontext
+def import_users_command(path, batch_size, workers, restart):
+    """Command for importing users from a CSV of username, email, password, admin"""
+    _run_import(
+        "users",
+        path,
+        restart,
+        lambda skip: import_users(
+            read_records(path, "csv"),
+            batch_size=batch_size,
+            workers=workers,
+            skip=skip,
+        ),
+    )
+
+
+@click.group("images")
+def images():
+    pass
+
+
+@images.command("backfill")
+@click.option("-w", "--workers", type=int, help="Number of worker processes")
+@click.option("-f", "--force", is_flag=True, help="Regenerate existing derivatives")
+@with_appcontext
+def backfill(workers, force):
+    """Command for generating the resized variants of existing uploads"""
+    directory = current_app.config["IMAGE_UPLOADS"]
+    filenames = [
+        filename
+        for filename in list_uploads(directory)
+        if force or not has_derivatives(directory, filename)
+    ]
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(generate_derivatives, directory, filename): filename
+            for filename in filenames
+        }
+        with click.progressbar(
+            as_completed(futures), length=len(futures), label="Resizing uploads"
+        ) as bar:
+            for future in bar:
+                try:
+                    future.result()
+                except OSError as e:
+                    failed.append((futures[future], e))
+
+    click.echo(f"Generated derivatives for {len(filenames) - len(failed)} uploads.")
+    for filename, e in failed:
+        click.echo(f"Skipped {filename}: {e}")
+
+
+@images.command("migrate-storage")
+@click.option("-b", "--batch-size", default=100, help="Albums per transaction")
+@with_appcontext
+def migrate_storage(batch_size):
+    """Command for moving flat uploads into the content-addressed store"""
+    directory = current_app.config["IMAGE_UPLOADS"]
+    legacy = [
+        (album_id, image)
+        for album_id, image in db.session.query(Album.id, Album.image)
+        if not is_content_path(image)
+    ]
+    moved = 0
+    for start in range(0, len(legacy), batch_size):
+        batch = dict(legacy[start : start + batch_size])
+        migrated = []
+        for album in Album.query.filter(Album.id.in_(batch.keys())):
+            path = os.path.join(directory, album.image)
+            if not os.path.isfile(path):
+                click.echo(f"Skipped album {album.id}: {album.image} is missing")
+                continue
+            with open(path, "rb") as f:
+                extension = os.path.splitext(album.image)[1]
+                filename, created = store_stream(directory, f, extension)
+            if created:
+                try:
+                    generate_derivatives(directory, filename)
+                except OSError as e:
+                    click.echo(f"No derivatives for {filename}: {e}")
+            migrated.append(album.image)
+            album.image = filename
+        db.session.commit()
+        remove_files(directory, migrated)
+        moved += len(migrated)
+    click.echo(f"Moved {moved} uploads into the content-addressed store.")
+
+
+@images.command("gc")
+@click.option(
+    "--grace", default=3600, help="Keep unreferenced files younger than this (s)"
+)
+@with_appcontext
+def gc(grace):
+    """Command for removing stored files that no album references"""
+    directory = current_app.config["IMAGE_UPLOADS"]
+    referenced = {
+        path
+        for (path,) in db.session.query(StoredFile.path).filter(
+            StoredFile.refcount > 0
+        )
+    }
+    # Fresh files may belong to an album whose transaction is still open
+    cutoff = time.time() - grace
+    orphans = [
+        filename
+        for filename in list_uploads(directory)
+        if is_content_path(filename)
+        and filename not in referenced
+        and os.path.getmtime(os.path.join(directory, filename)) < cutoff
+    ]
+    remove_files(directory, orphans)
+    StoredFile.query.filter(StoredFile.refcount <= 0).delete()
+    db.session.commit()
+    click.echo(f"Removed {len(orphans)} unreferenced uploads.")
+
+
+# Runs an import generator with checkpoints and progress output, `start_import`
+# is called with the number of records to skip
+def _run_import(name, path, restart, start_import):
+    checkpoint = path + ".checkpoint"
+    skip = 0 if restart else read_checkpoint(checkpoint)
+    if skip:
+        click.echo(f"Resuming after record {skip} (--restart starts over).")
+    imported = 0
+    start = time.perf_counter()
+    for consumed, inserted, problems in start_import(skip):
+        write_checkpoint(checkpoint, consumed)
+        for number, problem in problems:
+            click.echo(f"Record {number}: {problem}")
+        imported += inserted
+        rate = imported / (time.perf_counter() - start)
+        click.echo(f"{consumed} records read, {imported} {name} imported ({rate:.0f}/s)")
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    click.echo(f"Imported {imported} {name}.")
+
+
+def _import(model, path, input_format, owner, images_dir, batch_size, workers, restart):
+    _run_import(
+        model.__tablename__,
+        path,
+        restart,
+        lambda skip: import_records(
+            model,
+            read_records(path, input_format),
+            owner=owner,
+            images_dir=images_dir or os.path.dirname(os.path.abspath(path)),
+            batch_size=batch_size,
+            workers=workers,
+            skip=skip,
+        ),
+    )
+
+
+def import_options(f):
+    for option in reversed(
+        [
+            click.argument("path", type=click.Path(exists=True, dir_okay=False)),
+            click.option(
+                "--format",
+                "input_format",
+                type=click.Choice(["ndjson", "csv"]),
+                help="Input format, guessed from the extension by default",
+            ),
+            click.option(
+                "-o", "--owner", help="Username of the owner of records without one"
+            ),
+            click.option(
+                "-i",
+                "--images",
+                "images_dir",
+                type=click.Path(exists=True, file_okay=False),
+                help="Directory image paths are relative to (the file's by default)",
+            ),
+            click.option("-b", "--batch-size", default=500, help="Rows per insert"),
+            click.option("-w", "--workers", type=int, help="Image worker processes"),
+            click.option(
+                "--restart", is_flag=True, help="Ignore the checkpoint of a previous run"
+            ),
+            with_appcontext,
+        ]
+    ):
+        f = option(f)
+    return f
+
+
+@click.group("album")
+def album():
+    pass
+
+
+@album.command("import")
+@import_options
+def import_albums(**options):
+    """Command for importing albums and their covers from NDJSON or CSV"""
+    _import(Album, **options)
+
+
+@click.group("tour")
+def tour():
+    pass
+
+
+@tour.command("import")
+@import_options
+def import_tours(**options):
+    """Command for importing tours from NDJSON or CSV"""
+    _import(Tour, **options)
+
+
+@click.group("catalog")
+def catalog():
+    pass
+
+
+def _report(progress):
+    start = time.perf_counter()
+    totals = {}
+    for table, count in progress:
+        totals[table] = count
+        rate = sum(totals.values()) / (time.perf_counter() - start)
+        click.echo(f"{count} {table} ({rate:.0f} rows/s)")
+    return totals, time.perf_counter() - start
+
+
+@catalog.command("dump")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--uploads", is_flag=True, help="Include the files albums use")
+@click.option("-b", "--batch-size", default=1000, help="Rows fetched per round trip")
+@with_appcontext
+def dump(path, uploads, batch_size):
+    """Command for dumping users, albums and tours as gzipped NDJSON"""
+    totals, elapsed = _report(dump_catalog(path, uploads, batch_size))
+    size = os.path.getsize(path) / 2 ** 20
+    click.echo(
+        f"Dumped {sum(totals.values())} records to {path} ({size:.1f} MiB) "
+        f"in {elapsed:.2f}s."
+    )
+
+
+@catalog.command("restore")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--uploads", is_flag=True, help="Also restore the dumped files")
+@click.option("-b", "--batch-size", default=1000, help="Rows per insert")
+@with_appcontext
+def restore(path, uploads, batch_size):
+    """Command for loading a catalog dump into an empty database"""
+    try:
+        totals, elapsed = _report(restore_catalog(path, uploads, batch_size))
+    except InvalidDump as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    click.echo(f"Restored {sum(totals.values())} records in {elapsed:.2f}s.")
+
+
+@click.group("profile")
+def profile():
+    pass
+
+
+@profile.command("token")
+@click.option("-e", "--endpoint", default="*", help="Endpoint the token is for")
+@with_appcontext
+def token(endpoint):
+    """Command for printing a signed X-Profile header value"""
+    click.echo(profile_token(current_app, endpoint))
+
+
+@profile.command("report")
+@click.option("-d", "--directory", help="Profile directory, PROFILER_DIR by default")
+@click.option("-e", "--endpoint", "endpoints", multiple=True, help="Endpoint to show")
+@click.option("-n", "--top", default=15, help="Hotspots per endpoint")
+@with_appcontext
+def report(directory, endpoints, top):
+    """Command for merging the stored profiles into per-endpoint hotspots"""
+    directory = directory or current_app.config["PROFILER_DIR"]
+    if not os.path.isdir(directory):
+        raise click.ClickException(f"No profiles in {directory}")
+    for endpoint, paths in profile_files(directory).items():
+        if endpoints and endpoint not in endpoints:
+            continue
+        collapsed = [path for path in paths if path.endswith(".collapsed")]
+        stats = [path for path in paths if path.endswith(".prof")]
+        if collapsed:
+            samples, own, total = merge_collapsed(collapsed)
+            samples = samples or 1
+            click.echo(f"{endpoint}: {len(collapsed)} profiles, {samples} samples")
+            click.echo(f"{'self':>7}{'total':>7}  frame")
+            for frame, count in own.most_common(top):
+                click.echo(
+                    f"{count / samples:>7.1%}{total[frame] / samples:>7.1%}  {frame}"
+                )
+        if stats:
+            stream = io.StringIO()
+            merged = pstats.Stats(*stats, stream=stream)
+            merged.strip_dirs().sort_stats("tottime").print_stats(top)
+            click.echo(f"{endpoint}: {len(stats)} profiles")
+            click.echo(stream.getvalue().strip("\n"))
+        click.echo()
+
+
+@click.group("search")
+def search():
+    pass
+
+
+@search.command("rebuild")
+@with_appcontext
+def rebuild():
+    """Command for rebuilding the full-text index of albums and tours"""
+    start = time.perf_counter()
+    rebuild_index()
+    click.echo(
+        "Search index rebuilt in {:.2f}s.".format(time.perf_counter() - start)
+    )
+
+
 def register_click_commands(app):
     app.cli.add_command(test)
     app.cli.add_command(list_bp_endpoints)
+    app.cli.add_command(metrics)
     app.cli.add_command(user)
+    app.cli.add_command(images)
+    app.cli.add_command(album)
+    app.cli.add_command(tour)
+    app.cli.add_command(catalog)
+    app.cli.add_command(profile)
+    app.cli.add_command(search)
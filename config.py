@@ -8,18 +8,59 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     ADMIN_VIEWS = []
     LANGUAGES = ["en", "hr"]
-
-CACHE_TYPE = "redis"
-CACHE_REDIS_HOST = "localhost"
-CACHE_REDIS_PORT = "6379"
-CACHE_REDIS_DB = "0"
+    ITEMS_PER_PAGE = 20
+    ADMIN_ITEMS_PER_PAGE = 50
+    # Deeper search pages are clamped to the last one
+    SEARCH_MAX_PAGE = 50
+    FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+    METRICS_ENABLED = True
+    # /metrics answers requests carrying "Authorization: Bearer <METRICS_TOKEN>",
+    # and requests from METRICS_ALLOWED_IPS. Behind a reverse proxy every
+    # request comes from the proxy's address, so only list addresses when the
+    # app sees real client addresses (e.g. through werkzeug's ProxyFix)
+    METRICS_ALLOWED_IPS = [
+        ip for ip in os.environ.get("FLASK_METRICS_ALLOWED_IPS", "").split(",") if ip
+    ]
+    METRICS_TOKEN = os.environ.get("FLASK_METRICS_TOKEN")
+    # Fraction of events handed to the structured event log
+    TEMPLATE_LOG_SAMPLE_RATE = float(os.environ.get("FLASK_TEMPLATE_LOG_SAMPLE_RATE", 0.01))
+    ADMIN_LOG_SAMPLE_RATE = 1.0
+    # None, "x-accel-redirect" (nginx) or "x-sendfile" (Apache, lighttpd)
+    UPLOADS_SENDFILE = os.environ.get("FLASK_UPLOADS_SENDFILE")
+    UPLOADS_ACCEL_PREFIX = "/protected-uploads/"
+    # In-process LRU (L1) in front of a shared cache (L2), kept coherent
+    # across workers through Redis pub/sub
+    CACHE_TYPE = "app.cache_backends.TwoTierCache"
+    CACHE_L2_TYPE = "RedisCache"
+    CACHE_L1_SIZE = 2048
+    CACHE_L1_TIMEOUT = 30
+    CACHE_INVALIDATION_CHANNEL = "cache-invalidation"
+    CACHE_REDIS_HOST = os.environ.get("FLASK_REDIS_HOST") or "localhost"
+    CACHE_REDIS_PORT = 6379
+    CACHE_REDIS_DB = 0
+    # Opt-in profiling (app/profiler.py): the share of requests to
+    # PROFILER_ENDPOINTS (all when empty) that is profiled, and whether a
+    # signed X-Profile header from `flask profile token` may ask for it
+    PROFILER_SAMPLE_RATE = float(os.environ.get("FLASK_PROFILER_SAMPLE_RATE", 0))
+    PROFILER_ENDPOINTS = [
+        e for e in os.environ.get("FLASK_PROFILER_ENDPOINTS", "").split(",") if e
+    ]
+    PROFILER_HEADER = bool(os.environ.get("FLASK_PROFILER_HEADER"))
+    PROFILER_TOKEN_MAX_AGE = 60 * 60
+    # "collapsed" stacks sampled every PROFILER_INTERVAL seconds, or "pstats"
+    PROFILER_FORMAT = os.environ.get("FLASK_PROFILER_FORMAT", "collapsed")
+    PROFILER_INTERVAL = 0.005
+    PROFILER_DIR = os.environ.get("FLASK_PROFILER_DIR") or os.path.join(basedir, "profiles")
 
 class DevelopmentConfig(Config):
     SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, "globomantics.sqlite")
     IMAGE_UPLOADS = os.path.join(basedir, "uploads")
+    CACHE_L2_TYPE = "SimpleCache"
 
 class TestingConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False
+    CACHE_L2_TYPE = "SimpleCache"
     SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, "testing_db.sqlite")
     IMAGE_UPLOADS = os.path.join(basedir, "uploads")
 
@@ -1,14 +1,21 @@
+import io
 import os
+import shutil
+import tempfile
 import unittest
+import datetime
 from config import basedir
 from app import create_app, db
-from app.models import User
+from app.models import Album, Tour, User
 
 
 class TestExample(unittest.TestCase):
     def setUp(self):
         # Happens befor each test
         app = create_app("testing")
+        app.config["IMAGE_UPLOADS"] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config["IMAGE_UPLOADS"])
+        self.app = app
         self.app_ctx = app.app_context()
         self.app_ctx.push()
         self.app_test_client = app.test_client()
@@ -33,6 +40,1179 @@ class TestExample(unittest.TestCase):
         assert u.username == "test"
         assert u.check_password("password123")
 
+    def login(self, username="tester", email="tester@gmail.com"):
+        u = User(username=username, email=email, password="password123")
+        db.session.add(u)
+        db.session.commit()
+        self.app_test_client.post(
+            "/en/login", data={"email": email, "password": "password123"}
+        )
+        return u
+
+    def test_anonymous_pages_cached_per_language(self):
+        from app import cache
+
+        client = self.app.test_client()
+        english = client.get("/en/")
+        self.assertEqual(english.status_code, 200)
+        self.assertIn("public", english.headers["Cache-Control"])
+        self.assertNotIn("Vary", english.headers)
+        self.assertIn("lang=en", english.headers["Set-Cookie"])
+        etag = english.headers["ETag"]
+
+        # The language cookie is only sent again when it changes
+        again = client.get("/en/")
+        self.assertNotIn("Set-Cookie", again.headers)
+        self.assertEqual(again.headers["ETag"], etag)
+        revalidated = client.get("/en/", headers={"If-None-Match": etag})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.get_data(), b"")
+
+        croatian = client.get("/hr/")
+        self.assertIn("lang=hr", croatian.headers["Set-Cookie"])
+        self.assertNotEqual(croatian.headers["ETag"], etag)
+        self.assertNotEqual(croatian.get_data(), english.get_data())
+
+        # Query strings the page ignores share its cache entry
+        pages = cache.cache.l2
+        stored = len(pages._cache)
+        for n in range(3):
+            resp = client.get(f"/en/?x={n}")
+            self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(pages._cache), stored)
+
+        self.login()
+        page = self.app_test_client.get("/en/")
+        self.assertIn("private", page.headers["Cache-Control"])
+        self.assertNotIn("ETag", page.headers)
+        self.assertIn("Hello", page.get_data(as_text=True))
+
+    def test_album_list_pagination(self):
+        u = self.login()
+        start = datetime.datetime(2020, 1, 1)
+        for i in range(25):
+            db.session.add(
+                Album(
+                    f"Album number {i}",
+                    "Artist",
+                    "Some description",
+                    "Rock",
+                    "cover.png",
+                    start + datetime.timedelta(days=i // 2),
+                    u.id,
+                )
+            )
+        db.session.commit()
+
+        resp = self.app_test_client.get("/en/album/")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(html.count('class="card text-center'), 20)
+        self.assertIn("Album number 24", html)
+        next_link = html.split('href="/en/album/?after=')[1].split('"')[0]
+
+        resp = self.app_test_client.get("/en/album/?after=" + next_link)
+        html = resp.get_data(as_text=True)
+        self.assertEqual(html.count('class="card text-center'), 5)
+        self.assertIn("Album number 0", html)
+        self.assertNotIn("Album number 24", html)
+        self.assertNotIn("?after=", html)
+
+    def test_album_list_invalidated_on_commit(self):
+        u = self.login()
+        album = Album(
+            "First album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.commit()
+        self.assertIn("First album", self.app_test_client.get("/en/album/").get_data(as_text=True))
+
+        album.title = "Renamed album"
+        db.session.commit()
+        html = self.app_test_client.get("/en/album/").get_data(as_text=True)
+        self.assertIn("Renamed album", html)
+        self.assertNotIn("First album", html)
+
+    def test_single_flight_collapses_misses(self):
+        import threading
+        from app.caching import get_or_set
+
+        calls = []
+        barrier = threading.Barrier(8)
+
+        def compute():
+            calls.append(1)
+            return "value"
+
+        def worker():
+            with self.app.app_context():
+                barrier.wait()
+                get_or_set("single-flight-test", compute)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_slug_cache_follows_title_changes(self):
+        from app import cache
+        from app.slug_cache import MISSING, slug_key
+
+        u = self.login()
+        album = Album(
+            "Cached album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.commit()
+        old_slug = album.slug
+        # Primed on create
+        self.assertIsNotNone(cache.get(slug_key(Album, old_slug)))
+        resp = self.app_test_client.get(f"/en/album/show/{old_slug}")
+        self.assertIn("Cached album", resp.get_data(as_text=True))
+
+        album.title = "Retitled album"
+        db.session.commit()
+        resp = self.app_test_client.get(f"/en/album/show/{old_slug}")
+        self.assertIn("Error 404", resp.get_data(as_text=True))
+        resp = self.app_test_client.get(f"/en/album/show/{album.slug}")
+        self.assertIn("Retitled album", resp.get_data(as_text=True))
+
+        self.app_test_client.get("/en/album/show/unknown-slug")
+        self.assertEqual(cache.get(slug_key(Album, "unknown-slug")), MISSING)
+
+        # Created, renamed and deleted within one transaction
+        album = Album(
+            "Short lived album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.flush()
+        first_slug = album.slug
+        album.title = "Renamed short lived album"
+        db.session.flush()
+        db.session.delete(album)
+        db.session.commit()
+        for slug in (first_slug, album.slug):
+            self.assertIsNone(cache.get(slug_key(Album, slug)))
+            resp = self.app_test_client.get(f"/en/album/show/{slug}")
+            self.assertIn("Error 404", resp.get_data(as_text=True))
+
+    def test_load_user_uses_cached_identity(self):
+        from app.models import load_user
+
+        u = self.login()
+        identity = load_user(u.get_id())
+        self.assertEqual(identity.username, "tester")
+        self.assertFalse(identity.is_admin)
+        self.assertEqual(identity.get_id(), u.get_id())
+
+        u.make_admin()
+        db.session.commit()
+        self.assertTrue(load_user(u.get_id()).is_admin)
+
+        # A password change ends the sessions started with the old one
+        old_id = u.get_id()
+        u.set_password("new-password123")
+        db.session.commit()
+        self.assertIsNone(load_user(old_id))
+        self.assertIsNotNone(load_user(u.get_id()))
+        resp = self.app_test_client.get("/en/album/")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("/login", resp.location)
+
+        db.session.delete(u)
+        db.session.commit()
+        self.assertIsNone(load_user(u.get_id()))
+
+    def test_sessions_with_bare_ids_are_upgraded(self):
+        from flask_login.utils import decode_cookie, encode_cookie
+
+        u = self.login()
+        with self.app_test_client.session_transaction() as sess:
+            sess["_user_id"] = str(u.id)
+        self.assertEqual(self.app_test_client.get("/en/album/").status_code, 200)
+        with self.app_test_client.session_transaction() as sess:
+            self.assertEqual(sess["_user_id"], u.get_id())
+
+        # Remember cookies are re-issued with the new id
+        client = self.app.test_client()
+        client.set_cookie("localhost", "remember_token", encode_cookie(str(u.id)))
+        resp = client.get("/en/album/")
+        self.assertEqual(resp.status_code, 200)
+        cookie = [c for c in client.cookie_jar if c.name == "remember_token"][0]
+        self.assertEqual(decode_cookie(cookie.value.strip('"')), u.get_id())
+
+    def test_records_are_compact_and_versioned(self):
+        import pickle
+        from app.models import ALBUM_CARD, ALBUM_SNAPSHOT
+        from app.records import RecordType
+
+        u = self.login()
+        album = Album(
+            "Recorded album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.commit()
+
+        payload = ALBUM_CARD.dumps(album)
+        record = ALBUM_CARD.loads(payload)
+        self.assertEqual(record.release_date, album.release_date)
+        self.assertEqual(record.user.username, "tester")
+        self.assertEqual(repr(record), repr(album))
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertLess(len(payload) * 3, len(pickle.dumps(album)))
+
+        # Another column layout is another version, old keys go unread
+        self.assertNotEqual(
+            RecordType(Album, ("id", "slug")).version, ALBUM_SNAPSHOT.version
+        )
+
+    def test_admin_table_renders_projected_rows(self):
+        u = self.login()
+        u.make_admin()
+        db.session.commit()
+        self.upload_album("Projected album")
+        html = self.app_test_client.get("/en/admin/album/").get_data(as_text=True)
+        self.assertIn("Projected album", html)
+        html = self.app_test_client.get("/en/admin/user/").get_data(as_text=True)
+        self.assertIn("tester@gmail.com", html)
+
+    def test_admin_table_sorts_filters_and_paginates(self):
+        import html
+        import re
+
+        u = self.login()
+        u.make_admin()
+        for title in ("Banana", "Apricot", "Cherry", "Apple"):
+            db.session.add(
+                Album(
+                    title,
+                    "Artist",
+                    "Description",
+                    "Rock",
+                    "cover.png",
+                    datetime.datetime(2020, 1, 1),
+                    u.id,
+                )
+            )
+        db.session.commit()
+        self.app.config["ADMIN_ITEMS_PER_PAGE"] = 2
+
+        page = self.app_test_client.get("/en/admin/album/?sort=title&order=asc")
+        text = page.get_data(as_text=True)
+        self.assertLess(text.index("Apple"), text.index("Apricot"))
+        self.assertNotIn("Banana", text)
+        next_url = html.unescape(re.search(r'href="([^"]*after=[^"]*)"', text)[1])
+        text = self.app_test_client.get(next_url).get_data(as_text=True)
+        self.assertLess(text.index("Banana"), text.index("Cherry"))
+        self.assertNotIn("Apple", text)
+
+        text = self.app_test_client.get(
+            "/en/admin/album/?sort=title&order=asc&title=Ap"
+        ).get_data(as_text=True)
+        self.assertIn("Apricot", text)
+        self.assertNotIn("Banana", text)
+        self.assertNotIn("after=", text)
+
+        resp = self.app_test_client.get("/en/admin/album/?sort=description")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app_test_client.get("/en/admin/album/?release_date=never")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_admin_tables_page_on_every_sortable_column(self):
+        import html
+        import re
+        from app.admin.views import sortable_columns
+
+        u = self.login()
+        u.make_admin()
+        db.session.add(User("second", "second@gmail.com", "password123"))
+        for i in range(3):
+            day = datetime.datetime(2020, 1, 1 + i)
+            db.session.add(Album(f"Album {i}", "A", "D", "Rock", "a.png", day, u.id))
+            db.session.add(Tour(f"Tour {i}", "A", "D", "Rock", day, day, u.id))
+        db.session.commit()
+        self.app.config["ADMIN_ITEMS_PER_PAGE"] = 1
+
+        for model in (Album, Tour, User):
+            name = model.__name__.lower()
+            for column in sortable_columns(model.__table__):
+                for order in ("asc", "desc"):
+                    url = f"/en/admin/{name}/?sort={column}&order={order}"
+                    seen = 0
+                    while url:
+                        resp = self.app_test_client.get(url)
+                        self.assertEqual(resp.status_code, 200, url)
+                        text = resp.get_data(as_text=True)
+                        seen += 1
+                        found = re.search(r'href="([^"]*after=[^"]*)"', text)
+                        url = found and html.unescape(found[1])
+                    self.assertEqual(seen, model.query.count(), (name, column, order))
+
+        # Booleans are filtered on but not sorted on
+        self.assertNotIn("is_admin", sortable_columns(User.__table__))
+        resp = self.app_test_client.get("/en/admin/user/?sort=is_admin")
+        self.assertEqual(resp.status_code, 400)
+        text = self.app_test_client.get("/en/admin/user/?is_admin=true").get_data(
+            as_text=True
+        )
+        self.assertIn("tester", text)
+        self.assertNotIn("second@gmail.com", text)
+
+    def test_admin_bulk_update_keeps_tour_dates_ordered(self):
+        u = self.login()
+        u.make_admin()
+        day = datetime.datetime(2020, 1, 1)
+        for i in range(2):
+            db.session.add(Tour(f"Tour {i}", "A", "D", "Rock", day, day, u.id))
+        db.session.commit()
+        ids = [tour.id for tour in Tour.query]
+
+        for dates in (
+            {"start_date": "2030-01-01"},
+            {"end_date": "2019-01-01"},
+            {"start_date": "2030-01-01", "end_date": "2029-01-01"},
+        ):
+            resp = self.app_test_client.post(
+                "/en/admin/tour/bulk", data={"action": "update", "ids": ids, **dates}
+            )
+            self.assertEqual(resp.status_code, 400, dates)
+        self.assertEqual({t.start_date for t in Tour.query}, {day})
+
+        resp = self.app_test_client.post(
+            "/en/admin/tour/bulk",
+            data={
+                "action": "update",
+                "ids": ids,
+                "start_date": "2030-01-01",
+                "end_date": "2030-02-01",
+            },
+        )
+        self.assertEqual(resp.status_code, 302)
+        db.session.expire_all()
+        self.assertEqual(
+            {(t.start_date, t.end_date) for t in Tour.query},
+            {(datetime.datetime(2030, 1, 1), datetime.datetime(2030, 2, 1))},
+        )
+
+    def test_admin_bulk_delete_runs_constant_statements(self):
+        from app.query_counter import count_queries
+
+        u = self.login()
+        u.make_admin()
+        db.session.commit()
+        day = datetime.datetime(2020, 1, 1)
+        counts = []
+        for n in (2, 8):
+            for i in range(n):
+                db.session.add(
+                    Album(f"Album {n} {i}", "A", "D", "Rock", "a.png", day, u.id)
+                )
+            db.session.commit()
+            ids = [album.id for album in Album.query]
+            with count_queries() as queries:
+                self.app_test_client.post(
+                    "/en/admin/album/bulk", data={"action": "delete", "ids": ids}
+                )
+            self.assertEqual(Album.query.count(), 0)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_admin_bulk_update_and_delete(self):
+        from app.models import StoredFile
+        from app.signals import admin_deleted
+        from cli import gc
+
+        u = self.login()
+        u.make_admin()
+        db.session.commit()
+        for title in ("First bulk album", "Second bulk album"):
+            self.upload_album(title)
+        self.app_test_client.get("/en/album/")
+        ids = [album.id for album in Album.query]
+        self.assertEqual(StoredFile.query.one().refcount, 2)
+
+        resp = self.app_test_client.post(
+            "/en/admin/album/bulk",
+            data={"action": "update", "ids": ids, "genre": "Shoegaze"},
+        )
+        self.assertEqual(resp.status_code, 302)
+        html = self.app_test_client.get("/en/album/").get_data(as_text=True)
+        self.assertEqual(html.count("Shoegaze"), 2)
+        html = self.app_test_client.get("/en/search?q=shoegaze").get_data(as_text=True)
+        self.assertIn("Second bulk album", html)
+
+        sent = []
+        receiver = lambda sender, **kw: sent.append(kw["r_id"])
+        admin_deleted.connect(receiver, self.app)
+        self.addCleanup(admin_deleted.disconnect, receiver, self.app)
+        self.app_test_client.post(
+            "/en/admin/album/bulk", data={"action": "delete", "ids": ids}
+        )
+        self.assertEqual(sent, [ids])
+        self.assertEqual(Album.query.count(), 0)
+        self.assertEqual(StoredFile.query.count(), 0)
+        self.app.test_cli_runner().invoke(gc, ["--grace", "0"])
+        files = [f for _, _, fs in os.walk(self.app.config["IMAGE_UPLOADS"]) for f in fs]
+        self.assertEqual(files, [])
+        html = self.app_test_client.get("/en/album/").get_data(as_text=True)
+        self.assertNotIn("bulk album", html)
+        html = self.app_test_client.get("/en/search?q=bulk").get_data(as_text=True)
+        self.assertNotIn("bulk album", html)
+
+        # Deleting users takes their albums along, as the ORM cascade would
+        other = User("other", "other@gmail.com", "password123")
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(
+            Album(
+                "Orphan",
+                "Artist",
+                "Description",
+                "Rock",
+                "cover.png",
+                datetime.datetime(2020, 1, 1),
+                other.id,
+            )
+        )
+        db.session.commit()
+        self.app_test_client.post(
+            "/en/admin/user/bulk", data={"action": "delete", "ids": [other.id]}
+        )
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Album.query.count(), 0)
+
+    def test_user_deletion_cascades_in_constant_statements(self):
+        from sqlalchemy import event
+        from app.models import StoredFile
+
+        def add_user(name, albums):
+            user = User(name, f"{name}@gmail.com", "password123")
+            db.session.add(user)
+            db.session.commit()
+            for i in range(albums):
+                db.session.add(
+                    Album(
+                        f"{name} album {i}",
+                        "Artist",
+                        "Description",
+                        "Rock",
+                        f"{name}.png",
+                        datetime.datetime(2020, 1, 1),
+                        user.id,
+                    )
+                )
+            db.session.commit()
+            return user
+
+        def delete_counting_statements(user):
+            statements = []
+
+            def count(*args):
+                statements.append(args[2])
+
+            event.listen(db.engine, "before_cursor_execute", count)
+            db.session.delete(user)
+            db.session.commit()
+            event.remove(db.engine, "before_cursor_execute", count)
+            return len(statements)
+
+        few, many = add_user("few", 1), add_user("many", 5)
+        self.assertEqual(StoredFile.query.get("many.png").refcount, 5)
+        self.assertEqual(
+            delete_counting_statements(few), delete_counting_statements(many)
+        )
+        self.assertEqual(Album.query.count(), 0)
+        self.assertEqual(StoredFile.query.count(), 0)
+        documents = db.session.execute("SELECT count(*) FROM search_index").scalar()
+        self.assertEqual(documents, 0)
+
+    def upload_album(self, title="Uploaded album"):
+        from PIL import Image
+
+        cover = io.BytesIO()
+        Image.new("RGBA", (2000, 1500), (200, 30, 30, 128)).save(cover, "PNG")
+        cover.seek(0)
+        return self.app_test_client.post(
+            "/en/album/create",
+            data={
+                "title": title,
+                "artist": "Artist",
+                "description": "Some description",
+                "genre": "Rock",
+                "release_date": "2020-01-01",
+                "image": (cover, "cover.png"),
+            },
+            content_type="multipart/form-data",
+        )
+
+    def test_query_budgets(self):
+        from app import cache
+        from app.query_counter import QueryBudgetExceeded, query_budget
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget(1, label="two lookups"):
+                User.query.filter_by(username="a").first()
+                User.query.filter_by(email="b").first()
+        self.assertIn("two lookups ran 2 statements, budget 1", str(raised.exception))
+        self.assertIn("WHERE users.email = ?", str(raised.exception))
+
+        @query_budget(1)
+        def lookup():
+            return User.query.first()
+
+        lookup()
+        self.assertRaises(QueryBudgetExceeded, query_budget(0)(lookup))
+
+        user = self.login()
+        for count in (3, 12):
+            for i in range(count):
+                day = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=i)
+                db.session.add(
+                    Album(f"Album {i}", "A", "D", "Rock", "a.png", day, user.id)
+                )
+                db.session.add(Tour(f"Tour {i}", "A", "D", "Rock", day, day, user.id))
+            db.session.commit()
+            # Cold caches: the user identity and one page query at most
+            for path in ("/en/album/", "/en/tour/"):
+                cache.clear()
+                with query_budget(2, label=path):
+                    self.assertEqual(self.app_test_client.get(path).status_code, 200)
+
+        # The form's email check and the view share one lookup
+        with query_budget(1, label="login"):
+            self.app.test_client().post(
+                "/en/login", data={"email": "tester@gmail.com", "password": "password123"}
+            )
+        # One query checks the username and email
+        with query_budget(3, label="registration"):
+            self.app.test_client().post(
+                "/en/register",
+                data={
+                    "username": "newcomer",
+                    "email": "newcomer@gmail.com",
+                    "password": "password1234",
+                    "password_confirm": "password1234",
+                },
+            )
+        self.assertIsNotNone(User.query.filter_by(username="newcomer").first())
+
+    def test_request_memo_follows_flushes(self):
+        from app.query_counter import count_queries
+        from app.request_memo import lookup
+
+        self.test_user_creation()
+        with self.app.test_request_context():
+            with count_queries() as queries:
+                user = lookup(User, "email", "tet@gmail.com")
+                self.assertIs(lookup(User, "email", "tet@gmail.com"), user)
+                self.assertIsNone(lookup(User, "username", "later"))
+                self.assertIsNone(lookup(User, "username", "later"))
+            self.assertEqual(len(queries), 2)
+
+            # Writing a user forgets the memoized users, misses included
+            db.session.add(User("later", "later@gmail.com", "password123"))
+            db.session.flush()
+            self.assertEqual(lookup(User, "username", "later").email, "later@gmail.com")
+            db.session.rollback()
+        with self.app.test_request_context(), count_queries() as queries:
+            lookup(User, "email", "tet@gmail.com")
+        self.assertEqual(len(queries), 1)
+
+    def test_profiler_samples_selected_endpoints(self):
+        from app.profiler import _start_profile, profile_token, register_profiler
+        from cli import report
+
+        self.assertNotIn(_start_profile, self.app.before_request_funcs.get(None, []))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config.update(
+            PROFILER_SAMPLE_RATE=1.0,
+            PROFILER_ENDPOINTS=["album.list"],
+            PROFILER_HEADER=True,
+            PROFILER_INTERVAL=0.0001,
+            PROFILER_DIR=directory,
+        )
+        register_profiler(self.app)
+        self.login()
+        self.app_test_client.get("/en/album/")
+        self.app_test_client.get("/en/tour/")
+        self.assertEqual(
+            [name.split(".")[:2] for name in os.listdir(directory)], [["album", "list"]]
+        )
+
+        self.app.config["PROFILER_FORMAT"] = "pstats"
+        self.app_test_client.get("/en/tour/", headers={"X-Profile": "forged"})
+        self.app_test_client.get(
+            "/en/tour/", headers={"X-Profile": profile_token(self.app, "tour.list")}
+        )
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        result = self.app.test_cli_runner().invoke(report, ["-d", directory])
+        self.assertIn("album.list: 1 profiles", result.output)
+        self.assertIn("tour.list: 1 profiles", result.output)
+        self.assertIn("tottime", result.output)
+
+    def test_upload_serves_resized_variants(self):
+        from PIL import Image
+
+        self.login()
+        self.upload_album()
+        album = Album.query.one()
+        resp = self.app_test_client.get(f"/en/album/uploads/{album.image}?size=thumb")
+        thumb = Image.open(io.BytesIO(resp.data))
+        self.assertEqual(thumb.format, "JPEG")
+        self.assertEqual(max(thumb.size), 160)
+        resp = self.app_test_client.get(f"/en/album/uploads/{album.image}")
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (2000, 1500))
+
+    def test_upload_conditional_requests(self):
+        self.login()
+        self.upload_album()
+        url = f"/en/album/uploads/{Album.query.one().image}?size=card"
+        resp = self.app_test_client.get(url)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        etag = resp.headers["ETag"]
+
+        resp = self.app_test_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app_test_client.get(url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(len(resp.data), 10)
+
+        self.app.config["UPLOADS_SENDFILE"] = "x-accel-redirect"
+        resp = self.app_test_client.get(url)
+        self.assertTrue(resp.headers["X-Accel-Redirect"].startswith("/protected-uploads/"))
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.data, b"")
+
+    def test_unreadable_uploads_are_rejected(self):
+        from unittest import mock
+        from PIL import Image
+        from app.storage import list_uploads
+
+        self.login()
+        # Decompression bombs are refused before they are decoded
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 1000):
+            resp = self.upload_album("Bomb upload")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("The image could not be read.", resp.get_data(as_text=True))
+
+        resp = self.app_test_client.post(
+            "/en/album/create",
+            data={
+                "title": "Garbage upload",
+                "artist": "Artist",
+                "description": "Some description",
+                "genre": "Rock",
+                "release_date": "2020-01-01",
+                "image": (io.BytesIO(b"not an image"), "cover.png"),
+            },
+            content_type="multipart/form-data",
+        )
+        self.assertIn("The image could not be read.", resp.get_data(as_text=True))
+        self.assertEqual(Album.query.count(), 0)
+        self.assertEqual(list(list_uploads(self.app.config["IMAGE_UPLOADS"])), [])
+
+    def test_identical_uploads_share_one_file(self):
+        from app.models import StoredFile
+        from cli import gc
+
+        self.login()
+        self.upload_album("First upload")
+        self.upload_album("Second upload")
+        first, second = Album.query.order_by(Album.id).all()
+        self.assertEqual(first.image, second.image)
+        self.assertRegex(first.image, r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$")
+        self.assertEqual(StoredFile.query.get(first.image).refcount, 2)
+
+        path = os.path.join(self.app.config["IMAGE_UPLOADS"], first.image)
+        self.app_test_client.post(f"/en/album/delete/{first.slug}")
+        self.assertTrue(os.path.exists(path))
+        self.app_test_client.post(f"/en/album/delete/{second.slug}")
+        self.assertIsNone(StoredFile.query.get(first.image))
+
+        # Unreferenced files wait for gc, and re-uploads restart their grace
+        # period, so an upload in flight never loses its file
+        os.utime(path, (0, 0))
+        self.upload_album("Third upload")
+        runner = self.app.test_cli_runner()
+        self.assertIn("Removed 0", runner.invoke(gc).output)
+        self.assertEqual(StoredFile.query.get(first.image).refcount, 1)
+        self.app_test_client.post(f"/en/album/delete/{Album.query.one().slug}")
+        self.assertIn("Removed 0", runner.invoke(gc).output)
+        self.assertTrue(os.path.exists(path))
+        self.assertIn("Removed 1", runner.invoke(gc, ["--grace", "0"]).output)
+        self.assertFalse(os.path.exists(path))
+
+    def test_migrate_storage_moves_flat_uploads(self):
+        from cli import migrate_storage
+
+        u = self.login()
+        directory = self.app.config["IMAGE_UPLOADS"]
+        with open(os.path.join(directory, "legacy.png"), "wb") as f:
+            f.write(b"legacy image bytes")
+        album = Album(
+            "Legacy album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "legacy.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(migrate_storage)
+        self.assertIn("Moved 1 uploads", result.output)
+        album = Album.query.one()
+        self.assertTrue(os.path.isfile(os.path.join(directory, album.image)))
+        self.assertFalse(os.path.exists(os.path.join(directory, "legacy.png")))
+
+    def test_catalog_import_commands(self):
+        import json
+        from PIL import Image
+        from app.models import StoredFile
+        from app.storage import list_uploads
+        from cli import import_albums, import_tours
+
+        self.login()
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        Image.new("RGB", (800, 800), (10, 20, 30)).save(os.path.join(source, "a.png"))
+        with open(os.path.join(source, "bad.png"), "wb") as f:
+            f.write(b"not an image")
+        albums = [
+            {"title": "Imported", "image": "a.png", "release_date": "2019-05-01"},
+            {"title": "Reissue", "image": "a.png", "release_date": "2020-05-01"},
+            {"title": "No cover", "image": "missing.png", "release_date": "2020-05-01"},
+            {"title": "No date", "image": "a.png"},
+            {"title": "Bad cover", "image": "bad.png", "release_date": "2020-05-01"},
+        ]
+        with open(os.path.join(source, "albums.ndjson"), "w") as f:
+            for album in albums:
+                album.update(artist="Artist", description="Description", genre="Rock")
+                f.write(json.dumps(album) + "\n")
+
+        result = self.app.test_cli_runner().invoke(
+            import_albums,
+            [os.path.join(source, "albums.ndjson"), "-o", "tester", "-b", "2"],
+        )
+        self.assertIn("Imported 2 albums", result.output)
+        self.assertIn("Record 3: image not stored", result.output)
+        self.assertIn("Record 4: release_date is missing", result.output)
+        self.assertIn("Record 5: image rejected", result.output)
+        stored = StoredFile.query.one()
+        self.assertEqual(stored.refcount, 2)
+        self.assertEqual({a.image for a in Album.query}, {stored.path})
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.app.config["IMAGE_UPLOADS"], stored.path))
+        )
+        self.assertEqual(
+            list(list_uploads(self.app.config["IMAGE_UPLOADS"])), [stored.path]
+        )
+        html = self.app_test_client.get("/en/search?q=reissue").get_data(as_text=True)
+        self.assertIn("Reissue", html)
+
+        # A checkpoint left by an interrupted run skips the committed records
+        path = os.path.join(source, "tours.csv")
+        with open(path, "w") as f:
+            f.write("title,artist,description,genre,start_date,end_date,owner\n")
+            for title in ("First", "Second", "Third"):
+                f.write(f"{title},Artist,Description,Rock,2020-01-01,2020-02-01,tester\n")
+        with open(path + ".checkpoint", "w") as f:
+            f.write("2")
+        result = self.app.test_cli_runner().invoke(import_tours, [path])
+        self.assertIn("Imported 1 tours", result.output)
+        self.assertEqual([t.title for t in Tour.query], ["Third"])
+        self.assertFalse(os.path.exists(path + ".checkpoint"))
+
+    def test_catalog_import_checks_records_and_slugs(self):
+        from unittest import mock
+        from cli import import_tours
+
+        u = self.login()
+        existing = Tour(
+            "Existing tour",
+            "Artist",
+            "Description",
+            "Rock",
+            datetime.datetime(2020, 1, 1),
+            datetime.datetime(2020, 2, 1),
+            u.id,
+        )
+        existing.slug = "taken"
+        db.session.add(existing)
+        db.session.commit()
+
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        path = os.path.join(source, "tours.csv")
+        with open(path, "w") as f:
+            f.write("title,artist,description,genre,start_date,end_date,owner\n")
+            f.write("Backwards,Artist,Description,Rock,2020-03-01,2020-02-01,tester\n")
+            f.write("Tiny,Artist,Description,Rock,2020-01-01,2020-02-01,tester\n")
+            f.write("Loud tour,A,Description,Rock,2020-01-01,2020-02-01,tester\n")
+            for title in ("First", "Second", "Third"):
+                f.write(f"{title},Artist,Description,Rock,2020-01-01,2020-02-01,tester\n")
+
+        # The first two valid rows draw the same slug, the third one a slug
+        # already in the table
+        slugs = ["same", "same", "taken", "fresh", "fresher"]
+        with mock.patch("app.catalog.make_slug", side_effect=slugs):
+            result = self.app.test_cli_runner().invoke(import_tours, [path])
+        self.assertIn("Imported 3 tours", result.output)
+        self.assertIn("Record 1: start_date is after end_date", result.output)
+        self.assertIn("Record 2: Title must be between 5 and 80", result.output)
+        self.assertIn("Record 3: Artist name must be between 2 and 30", result.output)
+        self.assertEqual(
+            {t.slug for t in Tour.query}, {"taken", "same", "fresh", "fresher"}
+        )
+
+    def test_user_import_skips_taken_names(self):
+        from cli import import_users_command
+
+        self.test_user_creation()
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        path = os.path.join(source, "users.csv")
+        with open(path, "w") as f:
+            f.write("username,email,password,admin\n")
+            f.write("alice,alice@gmail.com,alice-secret-1,yes\n")
+            f.write("test,new@gmail.com,test-secret-2,\n")
+            f.write("bobby,alice@gmail.com,bobby-secret-3,\n")
+            f.write("carol,carol@gmail.com,,\n")
+            f.write("dave1,dave@gmail.com,dave-secret-5,no\n")
+            f.write("erin1,erin@gmail.com,short,\n")
+            f.write("frank,frank-has-a-long-address@gmail.com,frank-secret-7,\n")
+            f.write("grace,grace-at-example.com,grace-secret-8,\n")
+            f.write(f"{'h' * 70},henry@gmail.com,henry-secret-9,\n")
+
+        result = self.app.test_cli_runner().invoke(
+            import_users_command, [path, "-b", "2", "-w", "2"]
+        )
+        self.assertIn("Imported 2 users", result.output)
+        self.assertIn("Record 2: test or new@gmail.com already exists", result.output)
+        self.assertIn("Record 3: bobby or alice@gmail.com already exists", result.output)
+        self.assertIn("Record 4: username, email and password are required", result.output)
+        self.assertIn("Record 6: Password must be between 10 and 40", result.output)
+        self.assertIn("Record 7: Email must be between", result.output)
+        self.assertIn("Record 8: You did not enter a valid email!", result.output)
+        self.assertIn("Record 9: Username must be between 5 and 20", result.output)
+        self.assertTrue(User.query.filter_by(username="alice").one().is_admin)
+        self.assertFalse(User.query.filter_by(username="dave1").one().is_admin)
+        self.assertEqual(User.query.count(), 3)
+
+        # Imported users log in through the login form
+        client = self.app.test_client()
+        resp = client.post(
+            "/en/login", data={"email": "alice@gmail.com", "password": "alice-secret-1"}
+        )
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(client.get("/en/album/").status_code, 200)
+
+    def test_catalog_dump_and_restore(self):
+        import gzip
+        import json
+        from PIL import Image
+        from app.models import StoredFile
+        from cli import dump, import_albums, restore
+
+        self.login()
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        Image.new("RGB", (800, 800), (10, 20, 30)).save(os.path.join(source, "a.png"))
+        with open(os.path.join(source, "albums.ndjson"), "w") as f:
+            for title in ("First", "Second", "Third"):
+                album = {"title": title, "image": "a.png", "release_date": "2019-05-01"}
+                album.update(artist="Artist", description="Description", genre="Rock")
+                f.write(json.dumps(album) + "\n")
+        runner = self.app.test_cli_runner()
+        runner.invoke(
+            import_albums, [os.path.join(source, "albums.ndjson"), "-o", "tester"]
+        )
+        tour = Tour(
+            title="Tour",
+            artist="Artist",
+            description="Description",
+            genre="Rock",
+            start_date=datetime.datetime(2020, 1, 1),
+            end_date=datetime.datetime(2020, 2, 1),
+            user_id=1,
+        )
+        db.session.add(tour)
+        db.session.commit()
+        image = Album.query.first().image
+
+        path = os.path.join(source, "catalog.ndjson.gz")
+        result = runner.invoke(dump, [path, "--uploads", "-b", "2"])
+        self.assertIn("Dumped 9 records", result.output)
+        result = runner.invoke(restore, [path])
+        self.assertIn("users is not empty", result.output)
+        bogus = os.path.join(source, "bogus.ndjson.gz")
+        with gzip.open(bogus, "wt") as f:
+            f.write(json.dumps({"format": 1, "tables": {"bogus": ["id"]}}) + "\n")
+        db.session.execute("DELETE FROM users")
+        result = runner.invoke(restore, [bogus])
+        self.assertIn("unknown tables ['bogus']", result.output)
+        db.session.rollback()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        shutil.rmtree(self.app.config["IMAGE_UPLOADS"])
+        result = runner.invoke(restore, [path, "--uploads", "-b", "2"])
+        self.assertIn("Restored 9 records", result.output)
+        self.assertEqual(
+            [a.title for a in Album.query.order_by(Album.id)], ["First", "Second", "Third"]
+        )
+        self.assertEqual(Tour.query.one().start_date, datetime.datetime(2020, 1, 1))
+        self.assertTrue(User.query.one().check_password("password123"))
+        self.assertEqual(StoredFile.query.one().refcount, 3)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.app.config["IMAGE_UPLOADS"], image))
+        )
+        self.app_test_client.post(
+            "/en/login", data={"email": "tester@gmail.com", "password": "password123"}
+        )
+        html = self.app_test_client.get("/en/search?q=second").get_data(as_text=True)
+        self.assertIn("Second", html)
+
+    def test_search_follows_album_and_tour_changes(self):
+        u = self.login()
+        album = Album(
+            "Midnight Sessions",
+            "The Owls",
+            "Late night jazz recordings",
+            "Jazz",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        tour = Tour(
+            "Owls on the road",
+            "The Owls",
+            "European summer tour",
+            "Jazz",
+            datetime.datetime(2020, 6, 1),
+            datetime.datetime(2020, 8, 1),
+            u.id,
+        )
+        db.session.add_all([album, tour])
+        db.session.commit()
+
+        html = self.app_test_client.get("/en/search?q=owl").get_data(as_text=True)
+        self.assertIn("Midnight Sessions", html)
+        self.assertIn("Owls on the road", html)
+
+        album.description = "Early morning recordings"
+        db.session.commit()
+        html = self.app_test_client.get("/en/search?q=jazz late").get_data(as_text=True)
+        self.assertNotIn("Midnight Sessions", html)
+
+        db.session.delete(tour)
+        db.session.commit()
+        html = self.app_test_client.get("/en/search?q=european").get_data(as_text=True)
+        self.assertNotIn("Owls on the road", html)
+
+        # Page numbers beyond any OFFSET the database takes are clamped
+        resp = self.app_test_client.get(f"/en/search?q=owl&page={2 ** 63}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_search_refuses_unsupported_databases(self):
+        from unittest import mock
+        import config
+
+        with mock.patch.object(
+            config.TestingConfig, "SQLALCHEMY_DATABASE_URI", "mysql://user@localhost/db"
+        ):
+            with self.assertRaises(ValueError):
+                create_app("testing")
+
+    def test_metrics_endpoint(self):
+        from app.metrics import metrics
+
+        def count(name, key):
+            histogram = metrics.snapshot()[name].get(key)
+            return histogram.count if histogram else 0
+
+        self.login()
+        requests = count("requests", "album.list")
+        renders = count("templates", "list_albums.html")
+        self.app_test_client.get("/en/album/")
+        self.app_test_client.get("/en/album/")
+        self.assertEqual(count("requests", "album.list"), requests + 2)
+        self.assertEqual(count("templates", "list_albums.html"), renders + 2)
+
+        # Proxied requests arrive from loopback, so no address is trusted by
+        # default and scrapes need the token
+        resp = self.app_test_client.get("/metrics")
+        self.assertEqual(resp.status_code, 403)
+        self.app.config["METRICS_TOKEN"] = "scrape-token"
+        resp = self.app_test_client.get(
+            "/metrics", headers={"Authorization": "Bearer scrape-token"}
+        )
+        text = resp.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{endpoint="album.list"}', text)
+        self.assertIn('sql_statements_total{endpoint="album.list"}', text)
+        self.assertIn('cache_requests_total{outcome="hit"}', text)
+        self.assertIn('cache_tier_requests_total{outcome="l1_hit"}', text)
+
+        remote = {"REMOTE_ADDR": "203.0.113.7"}
+        resp = self.app_test_client.get("/metrics", environ_base=remote)
+        self.assertEqual(resp.status_code, 403)
+        resp = self.app_test_client.get(
+            "/metrics",
+            environ_base=remote,
+            headers={"Authorization": "Bearer wrong-token"},
+        )
+        self.assertEqual(resp.status_code, 403)
+        resp = self.app_test_client.get(
+            "/metrics",
+            environ_base=remote,
+            headers={"Authorization": "Bearer scrape-token"},
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        # Listed addresses need no token
+        self.app.config["METRICS_ALLOWED_IPS"] = ["203.0.113.7"]
+        resp = self.app_test_client.get("/metrics", environ_base=remote)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_drop_expired_workers(self):
+        from app import cache
+        from app.metrics import WORKERS_KEY, _worker_key, collect, flush
+
+        flush(force=True)
+        cache.set(WORKERS_KEY, cache.get(WORKERS_KEY) + ["metrics:gone:1"], timeout=0)
+        collect()
+        self.assertEqual(cache.get(WORKERS_KEY), [_worker_key()])
+
+    def test_two_tier_cache_invalidates_other_workers(self):
+        from cachelib import SimpleCache
+        from app.cache_backends import LocalInvalidationBus, TwoTierCache
+
+        shared, bus = SimpleCache(), LocalInvalidationBus()
+        first, second = TwoTierCache(shared, bus), TwoTierCache(shared, bus)
+        first.set("key", {"value": 1})
+        self.assertEqual(second.get("key"), {"value": 1})
+        self.assertEqual(second.get("key"), {"value": 1})
+        self.assertEqual(second.stats, {"l1_hit": 1, "l2_hit": 1, "miss": 0})
+
+        # L1 hands out copies, callers can not change each other's values
+        second.get("key")["value"] = 3
+        self.assertEqual(second.get("key"), {"value": 1})
+
+        first.set("key", {"value": 2})
+        self.assertEqual(second.get("key"), {"value": 2})
+        first.delete_many("key", "missing")
+        self.assertIsNone(second.get("key"))
+        self.assertIsNone(shared.get("key"))
+
+    def test_event_log_summarizes_sampled_renders(self):
+        import json
+        from app.event_log import event_log
+
+        stream = io.StringIO()
+        event_log.stream = stream
+        self.addCleanup(setattr, event_log, "stream", None)
+        self.app.config["TEMPLATE_LOG_SAMPLE_RATE"] = 1.0
+
+        u = self.login()
+        db.session.add(
+            Album(
+                "Logged album",
+                "Artist",
+                "Some description",
+                "Rock",
+                "cover.png",
+                datetime.datetime(2020, 1, 1),
+                u.id,
+            )
+        )
+        db.session.commit()
+        self.app_test_client.get("/en/album/")
+        event_log.drain()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        record = [r for r in records if r.get("template") == "list_albums.html"][-1]
+        self.assertEqual(record["event"], "template_rendered")
+        self.assertEqual(record["endpoint"], "album.list")
+        self.assertEqual(record["context"]["albums"], {"type": "list", "len": 1})
+        self.assertNotIn("Logged album", stream.getvalue())
+
+    def test_card_fragments_follow_row_version(self):
+        from app import cache
+        from flask_caching import make_template_fragment_key
+
+        u = self.login()
+        album = Album(
+            "Fragment album",
+            "Artist",
+            "Some description",
+            "Rock",
+            "cover.png",
+            datetime.datetime(2020, 1, 1),
+            u.id,
+        )
+        db.session.add(album)
+        db.session.commit()
+        self.app_test_client.get("/en/album/")
+        self.app_test_client.get("/hr/album/")
+        key = make_template_fragment_key("album_card", vary_on=[str(album.id), "1", "en"])
+        self.assertIn("Fragment album", cache.get(key))
+        self.assertIsNotNone(
+            cache.get(make_template_fragment_key("album_card", vary_on=[str(album.id), "1", "hr"]))
+        )
+
+        album.genre = "Jazz"
+        db.session.commit()
+        self.assertEqual(album.version, 2)
+        self.assertIsNone(cache.get(key))
+        html = self.app_test_client.get("/en/album/").get_data(as_text=True)
+        self.assertIn("Jazz", html)
+        self.assertIn("Posted by you", html)
+
+        # An edit committed in between is overwritten, not refused, and the
+        # row still moves to a version no fragment was cached under
+        table = Album.__table__
+        db.session.execute(
+            table.update().where(table.c.id == album.id).values(genre="Blues", version=5)
+        )
+        album.genre = "Soul"
+        db.session.commit()
+        self.assertEqual((album.genre, album.version), ("Soul", 6))
+
+    def test_invalid_cursor(self):
+        self.login()
+        resp = self.app_test_client.get("/en/tour/?after=not-a-cursor")
+        self.assertIn("404", resp.get_data(as_text=True))
+
 
 if __name__ == "__main__":
     unittest.main()